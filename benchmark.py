@@ -0,0 +1,197 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import generate_dataset
+
+# Times loading and the main commands against generated collections of several sizes.  Each size is measured in a
+# fresh process so that peak memory is that size's alone, and the results are written to a json file that a later run
+# can be compared against with --compare.
+
+DEFAULT_SIZES = "1000,10000,100000"
+
+
+# The first run is kept apart: it pays for building name indexes and filling the result caches, which the repeats
+# then hit, so min and median are of the repeats only.
+def timed(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    warm = sorted(times[1:] or times)
+    return {"first": times[0], "min": warm[0], "median": warm[len(warm) // 2]}
+
+
+# The commands run through the same interpreter batch mode uses, so argument parsing, name matching and output are
+# all part of the timings.  Names come from generate_dataset's naming scheme.
+def queries(objects):
+    users, computers, groups = generate_dataset.split_objects(objects)
+    return [
+        ("list", "list users max=25 USER1"),
+        ("describe user", "describe user USER{}@".format(users // 2)),
+        ("sessions group", "sessions group GROUP{}@".format(groups - 1)),
+        ("sessions rollup", "sessions group 'DOMAIN USERS@EVIL.LOCAL'"),
+        ("overlap", "overlap 'DOMAIN USERS@EVIL.LOCAL' 'DOMAIN ADMINS@EVIL.LOCAL' GROUP{}@".format(groups - 1)),
+        ("histogram", "histogram sessions"),
+        ("targets", "targets 50"),
+        ("trace", "trace user USER{}@ group 'DOMAIN ADMINS@EVIL.LOCAL'".format(users - 1)),
+        ("reach", "reach group 'DOMAIN ADMINS@EVIL.LOCAL' max=0"),
+    ]
+
+
+def measure(path, objects, repeat):
+    import elementary
+    import elementary_data
+
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        elementary_data.load_collection(path)
+        results["load"] = time.perf_counter() - start
+    results["load_peak_mb"] = elementary_data.peak_memory_mb()
+    # Groups nested in each other, so a --cycles run that produced none is easy to spot.
+    results["group_cycles"] = sum(1 for members, _ in elementary_data.bh_data["groups"].components() if len(members) > 1)
+
+    source_files = [os.path.join(path, file) for file in elementary_data.COLLECTION_FILES]
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        snapshot_file = os.path.join(snapshot_dir, elementary_data.SNAPSHOT_FILE)
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            elementary_data.save_snapshot(snapshot_file, source_files)
+            results["snapshot_save"] = time.perf_counter() - start
+            start = time.perf_counter()
+            elementary_data.load_snapshot(snapshot_file, source_files)
+            results["snapshot_load"] = time.perf_counter() - start
+
+    interpreter = elementary.BHDCmd(pick="first", json_output=True)
+    results["commands"] = {}
+    for label, line in queries(objects):
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            results["commands"][label] = timed(lambda: interpreter.onecmd(interpreter.precmd(line)), repeat)
+        if '"error"' in output.getvalue():
+            results["commands"][label]["error"] = json.loads(output.getvalue().splitlines()[0])["error"]
+    results["peak_mb"] = elementary_data.peak_memory_mb()
+    return results
+
+
+DATASET_OPTIONS = ["domains", "depth", "cycles", "sessions", "groups_per_user", "admins_per_computer", "seed"]
+
+
+def dataset_options(args):
+    options = dict((option, getattr(args, option)) for option in DATASET_OPTIONS)
+    options["generator"] = generate_dataset.GENERATOR_VERSION
+    return options
+
+
+def dataset_path(data_dir, objects, args):
+    options = dataset_options(args)
+    return os.path.join(data_dir, "-".join([str(objects)] + [str(options[option]) for option in DATASET_OPTIONS] +
+                                           ["v{}".format(options["generator"])]))
+
+
+def run_size(objects, args):
+    path = dataset_path(args.data_dir, objects, args)
+    if not os.path.exists(os.path.join(path, "sessions.json")):
+        print("Generating {} objects into {}...".format(objects, path))
+        args.objects = objects
+        with contextlib.redirect_stdout(io.StringIO()):
+            generate_dataset.generate(path, generate_dataset.generator_from_args(args))
+    print("Measuring {} objects...".format(objects))
+    command = [sys.executable, os.path.abspath(__file__), "--measure", path, "--objects", str(objects),
+               "--repeat", str(args.repeat)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        print("  Measuring {} objects failed.".format(objects))
+        return None
+    return json.loads(output.splitlines()[-1])
+
+
+def flatten(results):
+    flat = {}
+    for key in ["load", "snapshot_save", "snapshot_load"]:
+        flat[key] = results.get(key)
+    for label, timing in results.get("commands", {}).items():
+        flat[label] = timing["median"]
+        if "first" in timing:
+            flat[label + " first"] = timing["first"]
+    return flat
+
+
+def print_results(results, baseline=None, threshold=1.25):
+    regressions = 0
+    for size, measured in results["sizes"].items():
+        print("{} objects (peak memory {:.0f} MB, {} group cycles):".format(size, measured.get("peak_mb") or 0,
+                                                                          measured.get("group_cycles", "?")))
+        before = None
+        if baseline is not None and size in baseline["sizes"]:
+            before = flatten(baseline["sizes"][size])
+        for label, seconds in flatten(measured).items():
+            line = "  {:<22} {:>9.4f}s".format(label, seconds)
+            error = measured.get("commands", {}).get(label, {}).get("error")
+            if error is not None:
+                line += "  ERROR: {}".format(error)
+            if before is not None and before.get(label):
+                ratio = seconds / before[label]
+                line += "  {:>6.2f}x".format(ratio)
+                if ratio > threshold:
+                    line += "  SLOWER"
+                    regressions += 1
+            print(line)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Bloodhound Elementary on generated collections.')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help="Comma separated numbers of objects to generate and measure (default: {}).".format(
+                            DEFAULT_SIZES))
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), "elementary-benchmark"),
+                        help="Where generated collections are kept between runs.")
+    parser.add_argument('--repeat', type=int, default=5, help="Times to run each command (default: 5).")
+    parser.add_argument('--output', help="Write the results to this json file.")
+    parser.add_argument('--compare', help="Compare against results written earlier with --output.")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="Report a command as slower when it takes this many times as long (default: 1.25).")
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    generate_dataset.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.measure is not None:
+        print(json.dumps(measure(args.measure, args.objects, args.repeat)))
+        sys.exit(0)
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "dataset": dataset_options(args),
+        "sizes": {},
+    }
+    for size in [int(size) for size in args.sizes.split(",")]:
+        measured = run_size(size, args)
+        if measured is not None:
+            results["sizes"][str(size)] = measured
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("dataset") != results["dataset"]:
+            print("Warning: {} was measured on differently generated data.".format(args.compare))
+    regressions = print_results(results, baseline, args.threshold)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Results written to {}.".format(args.output))
+    if regressions > 0:
+        print("{} measurements are more than {}x slower than {}.".format(regressions, args.threshold, args.compare))
+        sys.exit(1)
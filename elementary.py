@@ -1,19 +1,150 @@
 import argparse
+import contextlib
+import cProfile
+import csv
+import glob
+import io
+import json
 import os
+import re
 from elementary_data import *
 import cmd
+import concurrent.futures
 import sys
 import shlex
+import signal
+import socket
+import socketserver
+import stat
+import pstats
+import threading
+import time
+
+
+PROFILE_LINES = 25
+EXPORT_FORMATS = ["csv", "jsonl"]
+# The list columns of a CSV export hold names separated by ';'.
+EXPORT_COLUMNS = ["name", "groups", "local_admin", "remote_desktop", "sessions"]
+# For each histogram: the JSON key and label of the forward and the reverse direction of the relationship.
+HISTOGRAMS = {
+    "sessions": [("computers_per_user", "Computers each user has sessions on"),
+                 ("users_per_computer", "Users with sessions on each computer")],
+    "members": [("members_per_group", "Direct members of each group"),
+                ("groups_per_member", "Groups each member is directly in")],
+    "admins": [("admins_per_computer", "Direct local admins of each computer"),
+               ("computers_per_admin", "Computers each principal is a direct local admin of")],
+}
+
+
+def format_path(path):
+    path_parts = []
+    for type_label, name, edge in path:
+        if edge is not None:
+            path_parts.append("--{}-->".format(edge))
+        path_parts.append("{} {}".format(type_label[:-1], name))
+    return " ".join(path_parts)
+
+
+def path_steps(path):
+    return [{"type": type_label[:-1], "name": name, "edge": edge} for type_label, name, edge in path]
 
 
 class BHDCmd(cmd.Cmd):
-    def __init__(self):
-        print("Type 'help' for a list of commands.")
+    # With json_output every command prints one JSON object per line instead of text, and pick is handed to select_one
+    # so that ambiguous names are resolved without prompting (see BloodhoundObject.select_one).
+    def __init__(self, pick=None, json_output=False):
         cmd.Cmd.__init__(self)
         self.prompt = 'elementary> '
+        self.pick = pick
+        self.json_output = json_output
+        self.line = ""
+        self.timing = False
+        self.trace_timeout = None
+        self.export_dir = None
+        self.started = time.time()
+        self.types_singular = []
+        for key in bh_data.keys():
+            self.types_singular.append(key[:-1])
+        self.intro = "Type 'help' for a list of commands."
+
+    def precmd(self, line):
+        self.line = line.strip()
+        self.started = time.time()
+        return line
+
+    def postcmd(self, stop, line):
+        if self.timing and not self.json_output and len(line.strip()) > 0:
+            print("Took {:.3f}s.".format(time.time() - self.started))
+        return stop
+
+    def onecmd(self, line):
+        try:
+            return cmd.Cmd.onecmd(self, line)
+        except AmbiguousMatch as e:
+            self.fail(str(e), candidates=e.candidates)
+        except ValueError as e:
+            self.fail("Invalid value: {}".format(e))
+        except re.error as e:
+            self.fail("Invalid regular expression: {}".format(e))
+        except Exception as e:
+            # In batch mode one bad query shouldn't cost the answers to all the ones after it.
+            if not self.json_output:
+                raise
+            self.fail("Query failed: {}: {}".format(type(e).__name__, e))
+
+    def default(self, line):
+        if self.json_output:
+            self.fail("Unknown syntax: {}".format(line))
+        else:
+            cmd.Cmd.default(self, line)
+
+    def run_batch(self, lines):
+        for line in lines:
+            line = line.strip()
+            if len(line) > 0 and not line.startswith("#"):
+                line = self.precmd(line)
+                self.postcmd(self.onecmd(line), line)
+
+    def emit(self, result):
+        if self.timing:
+            result = dict(result, seconds=time.time() - self.started)
+        print(json.dumps(dict(query=self.line, **result)))
+        sys.stdout.flush()
+
+    def fail(self, message, **extra):
+        if self.json_output:
+            self.emit(dict(error=message, **extra))
+        else:
+            print(message)
+
+    def usage(self, command):
+        if self.json_output:
+            with redirect_output(io.StringIO()) as help_text:
+                getattr(self, "help_{}".format(command))()
+            self.fail(help_text.getvalue().strip())
+        else:
+            getattr(self, "help_{}".format(command))()
+
+    # cmd's help prints plain text (partly to self.stdout), which would break the one JSON object per line of batch
+    # and server output.
+    def do_help(self, arg):
+        if not self.json_output:
+            return cmd.Cmd.do_help(self, arg)
+        stdout = self.stdout
+        with redirect_output(io.StringIO()) as help_text:
+            self.stdout = help_text
+            try:
+                cmd.Cmd.do_help(self, arg)
+            finally:
+                self.stdout = stdout
+        self.emit({"help": help_text.getvalue().strip()})
+
+    def help_help(self):
+        print("List the commands, or describe one of them.  Syntax: help [command]")
 
     def do_exit(self, params):
-        print("Exiting...")
+        if not self.json_output:
+            print("Exiting...")
         sys.exit(0)
 
     def help_exit(self):
@@ -25,9 +156,9 @@ class BHDCmd(cmd.Cmd):
         pattern = ".*"
 
         if len(params) == 0:
-            self.help_list()
+            self.usage("list")
         elif params[0] not in bh_data.keys():
-            print("You can only list these: {}".format(", ".join(bh_data.keys())))
+            self.fail("You can only list these: {}".format(", ".join(bh_data.keys())))
         else:
             if len(params) > 1:
                 for param in params[1:]:
@@ -35,7 +166,11 @@ class BHDCmd(cmd.Cmd):
                         max_length = int(param[4:])
                     else:
                         pattern = param
-            bh_data[params[0]].print_list(pattern, max_length)
+            if self.json_output:
+                self.emit({"type": params[0], "pattern": pattern, "max": max_length,
+                           "results": bh_data[params[0]].list(pattern, max_length)})
+            else:
+                bh_data[params[0]].print_list(pattern, max_length)
 
     def help_list(self):
         print("List the names of a specified object type.  Syntax: list <{}> [max=<n>] [regex]".format(
@@ -44,83 +179,252 @@ class BHDCmd(cmd.Cmd):
     def do_describe(self, paramline):
         params = shlex.split(paramline)
         if len(params) != 2:
-            self.help_describe()
-        elif params[0] not in types_singular:
-            print("You can only describe these: {}".format(", ".join(types_singular)))
+            self.usage("describe")
+        elif params[0] not in self.types_singular:
+            self.fail("You can only describe these: {}".format(", ".join(self.types_singular)))
         else:
             data_type = "{}s".format(params[0])
-            match = bh_data[data_type].select_one(params[1])
+            match = bh_data[data_type].select_one(params[1], pick=self.pick)
             if match is None:
-                print("Could not find a {} object that matches.".format(params[0]))
+                self.fail("Could not find a {} object that matches.".format(params[0]))
+            elif self.json_output:
+                self.emit(dict(type=params[0], **bh_data[data_type].describe(match)))
             else:
                 bh_data[data_type].print_details(match)
 
     def help_describe(self):
-        print("Describe the specified object. Syntax: describe <{}> [regex]".format("|".join(types_singular)))
+        print("Describe the specified object. Syntax: describe <{}> [regex]".format("|".join(self.types_singular)))
+
+    def do_export(self, paramline):
+        params = shlex.split(paramline)
+        if len(params) not in [2, 3] or params[0] != "users":
+            self.usage("export")
+            return
+        file_format = params[2] if len(params) == 3 else "csv" if params[1].lower().endswith(".csv") else "jsonl"
+        if file_format not in EXPORT_FORMATS:
+            self.usage("export")
+            return
+        # Server mode: only plain file names, written to the folder given with --export-dir.
+        if self.export_dir is not None:
+            if os.path.basename(params[1]) != params[1] or params[1] in ["", ".", ".."]:
+                self.fail("Exports are written to {}, give a file name without a folder.".format(self.export_dir))
+                return
+            params[1] = os.path.join(self.export_dir, params[1])
+
+        count = 0
+        try:
+            with open(params[1], "w", newline="", encoding="utf-8") as f:
+                if file_format == "csv":
+                    writer = csv.writer(f)
+                    writer.writerow(EXPORT_COLUMNS)
+                for row in bh_data["users"].iter_access():
+                    if file_format == "csv":
+                        writer.writerow([row["name"]] + [";".join(row[column]) for column in EXPORT_COLUMNS[1:]])
+                    else:
+                        f.write(json.dumps(row) + "\n")
+                    count += 1
+        except OSError as e:
+            self.fail("Could not write {}: {}".format(params[1], e))
+            return
+        if self.json_output:
+            self.emit({"type": "users", "file": params[1], "format": file_format, "count": count})
+        else:
+            print("Exported {} users to {}.".format(count, params[1]))
+
+    def help_export(self):
+        print("Write every user's nested groups, effective local admin and remote desktop access and sessions to a "
+              "CSV or JSON Lines file.  Syntax: export users <file> [{}]".format("|".join(EXPORT_FORMATS)))
 
     def do_trace(self, paramline):
         params = shlex.split(paramline)
-        if len(params) != 4:
-            self.help_trace()
+        options = {"max_paths": 10, "max_depth": None, "timeout": self.trace_timeout}
+        for param in params[4:]:
+            option, _, value = param.partition("=")
+            option = "max_paths" if option == "max" else option
+            if option not in options or value == "":
+                self.usage("trace")
+                return
+            options[option] = float(value) if option == "timeout" else int(value)
+        # In server mode the query timeout is the longest any trace may look.
+        if self.trace_timeout is not None:
+            options["timeout"] = min(options["timeout"] or self.trace_timeout, self.trace_timeout)
+        if len(params) < 4:
+            self.usage("trace")
         elif params[0] not in ["user", "computer", "group"] or params[2] not in ["computer", "group", "user"]:
-            self.help_trace()
+            self.usage("trace")
         else:
             source_type = "{}s".format(params[0])
-            source_object = bh_data[source_type].select_one(params[1])
+            source_object = bh_data[source_type].select_one(params[1], pick=self.pick)
             target_type = "{}s".format(params[2])
-            target_object = bh_data[target_type].select_one(params[3])
+            target_object = bh_data[target_type].select_one(params[3], pick=self.pick)
             if source_object is None:
-                print("Could not find a {} matching name {}".format(params[0], params[1]))
+                self.fail("Could not find a {} matching name {}".format(params[0], params[1]))
             elif target_object is None:
-                print("Could not find a {} matching name {}".format(params[2], params[3]))
+                self.fail("Could not find a {} matching name {}".format(params[2], params[3]))
             else:
-                print("Tracing paths from {} {} to {} {} (this may take a few moments)".format(params[0], source_object,
-                                                                                               params[2],
-                                                                                               target_object))
-                paths = bh_data[source_type].trace(source_object, target_type, target_object, TraceHistory())
-                paths.sort(key=len)
-                for path in paths:
-                    path_parts = []
-                    for item in path:
-                        if "users" in item:
-                            path_parts.append("user {}".format(item.get("users")))
-                        elif "groups" in item:
-                            path_parts.append("group {}".format(item.get("groups")))
-                        elif "computers" in item:
-                            path_parts.append("computer {}".format(item.get("computers")))
-                    print("* {}".format(" --> ".join(path_parts)))
+                self.trace(params[0], source_object, params[2], target_object, **options)
+
+    # Paths are printed as they are found, so a long trace can be watched and stopped with Ctrl-C once it has shown
+    # enough; whatever was found until then is kept.
+    def trace(self, source_type, source_object, target_type, target_object, max_paths, max_depth, timeout):
+        if not self.json_output:
+            print("Tracing paths from {} {} to {} {}".format(source_type, source_object, target_type, target_object))
+            sys.stdout.flush()
+        paths = []
+        count = 0
+        stopped = None
+        start = time.time()
+        try:
+            for path in bh_data["{}s".format(source_type)].trace(source_object, "{}s".format(target_type),
+                                                                 target_object, max_paths, max_depth, timeout):
+                count += 1
+                if self.json_output:
+                    paths.append(path_steps(path))
+                else:
+                    # One write per path, so Ctrl-C can't land between a path and its newline.
+                    sys.stdout.write("* {}\n".format(format_path(path)))
+                    sys.stdout.flush()
+        except KeyboardInterrupt:
+            stopped = "cancelled"
+        if stopped is None and count > 0 and count == max_paths:
+            stopped = "max_paths"
+        elif stopped is None and timeout is not None and time.time() - start >= timeout:
+            stopped = "timeout"
 
+        if self.json_output:
+            self.emit({"source": {"type": source_type, "name": source_object},
+                       "target": {"type": target_type, "name": target_object},
+                       "max": max_paths, "max_depth": max_depth, "timeout": timeout, "stopped": stopped,
+                       "paths": paths})
+            return
+        if count == 0 and stopped is None:
+            print("No paths found{}.".format("" if max_depth is None else " of up to {} hops".format(max_depth)))
+        elif stopped == "max_paths":
+            print("* There may be more, I stopped looking after {}.  Use max=<n> to specify a higher limit.".format(
+                max_paths))
+        elif stopped == "timeout":
+            print("* There may be more, I stopped looking after {:g}s.  Use timeout=<seconds> to look for longer."
+                  .format(timeout))
+        elif stopped == "cancelled":
+            print("* Cancelled after {} paths.".format(count))
 
     def help_trace(self):
-        print(
-            "Trace paths from one object to another.  Syntax: trace <{}> <source> <{}> <target>".format("user|computer",
-                                                                                                        "computer|group"))
+        print("Trace the shortest paths from one object to another, shortest first.  Syntax: trace <{}> <source> <{}> "
+              "<target> [max=<n>] [max_depth=<hops>] [timeout=<seconds>]".format("user|computer|group",
+                                                                                 "user|computer|group"))
+        print("max (or max_paths) is the number of paths to look for, 10 by default and 0 for all of them.  Paths are "
+              "shown as they are found and Ctrl-C stops looking for more.")
+
+    def do_reach(self, paramline):
+        params = shlex.split(paramline)
+        max_sources = 25
+        if len(params) > 2 and params[-1].find("max=") == 0:
+            max_sources = int(params[-1][4:])
+            params = params[:-1]
+        if len(params) not in [2, 3] or params[0] not in ["user", "computer", "group"]:
+            self.usage("reach")
+            return
+        source_types = {"users": "users", "computers": "computers", "groups": "groups", "all": None}
+        source_type = "users" if len(params) == 2 else params[2]
+        if source_type not in source_types:
+            self.usage("reach")
+            return
+
+        target_type = "{}s".format(params[0])
+        target_object = bh_data[target_type].select_one(params[1], pick=self.pick)
+        if target_object is None:
+            self.fail("Could not find a {} matching name {}".format(params[0], params[1]))
+            return
+        sources = bh_data[target_type].reach(target_object, source_types[source_type])
+        shown = sources if max_sources == 0 else sources[:max_sources]
+        if self.json_output:
+            self.emit({"target": {"type": params[0], "name": target_object}, "sources": source_type,
+                       "max": max_sources, "count": len(sources),
+                       "results": [{"type": path[0][0][:-1], "name": name, "distance": distance,
+                                    "path": path_steps(path)} for name, distance, path in shown]})
+            return
+
+        print("Finding {} that can reach {} {}".format(
+            "everything" if source_type == "all" else source_type, params[0], target_object))
+        for name, distance, path in shown:
+            print("* {} hop{}: {}".format(distance, "" if distance == 1 else "s", format_path(path)))
+        if len(shown) < len(sources):
+            print("* Showing the nearest {}.  Use max=<n> to specify a higher limit, or max=0 for all.".format(
+                max_sources))
+        print("Found {} that can reach {} {}".format(len(sources), params[0], target_object))
+
+    def help_reach(self):
+        print("List everything with a path to the given object, nearest first, with one shortest path each.  "
+              "Syntax: reach <user|computer|group> <target> [users|computers|groups|all] [max=<n>]")
+
+    def do_reload(self, paramline):
+        params = shlex.split(paramline)
+        if len(params) != 2 or params[0] != "sessions":
+            self.usage("reload")
+            return
+        json_files = find_collection_files([params[1]])["sessions"]
+        # A single file may be named anything, as long as it holds a sessions array (checked while reading it).
+        if len(json_files) == 0 and os.path.isfile(params[1]) and params[1].lower().endswith(".json"):
+            json_files = [params[1]]
+        if len(json_files) == 0:
+            self.fail("Could not find a sessions file in {}".format(params[1]))
+            return
+
+        # Progress messages for large files must not end up between the JSON lines.
+        try:
+            with redirect_output(sys.stderr if self.json_output else sys.stdout):
+                print("Reloading sessions from {}...".format(", ".join(json_files)))
+                added, removed = reload_sessions(json_files)
+        except MissingArray as e:
+            self.fail("Not a sessions file, the loaded sessions were kept: {}".format(e))
+            return
+        total = sum(len(computers) for computers in bh_sessions["sessions"].data_dict["users"].values())
+        if self.json_output:
+            self.emit({"type": "sessions", "files": json_files, "added": added, "removed": removed,
+                       "sessions": total})
+        else:
+            print("  {} sessions added and {} removed, {} sessions now.".format(added, removed, total))
+
+    def help_reload(self):
+        print("Replace the loaded sessions with those in a new sessions file (or folder or zip file holding one), "
+              "leaving everything else as it is.  Syntax: reload sessions <file>")
 
     def do_sessions(self, paramline):
         params = shlex.split(paramline)
         supported = ["user", "computer", "group"]
         if len(params) != 2 or params[0] not in supported:
-            self.help_sessions()
-        else:
-            full_name = bh_data["{}s".format(params[0])].select_one(params[1])
-            if full_name is None:
-                print("Could not find a {} matching name {}".format(params[0], params[1]))
-            elif params[0] == "user":
+            self.usage("sessions")
+            return
+
+        full_name = bh_data["{}s".format(params[0])].select_one(params[1], pick=self.pick)
+        if full_name is None:
+            self.fail("Could not find a {} matching name {}".format(params[0], params[1]))
+        elif params[0] == "user":
+            computers = sorted(bh_sessions["sessions"].for_user(full_name))
+            if self.json_output:
+                self.emit({"type": "user", "name": full_name, "computers": computers})
+            else:
                 print("Finding {} computer sessions:".format(full_name))
-                computers = set(bh_sessions["sessions"].for_user(full_name))
                 for c in computers:
                     print(c)
-            elif params[0] == "group":
+        elif params[0] == "group":
+            sessions, computers = bh_sessions["sessions"].for_users(sorted(bh_data["groups"].users(full_name)))
+            users = [{"user": u, "computers": c} for u, c in sessions]
+            if self.json_output:
+                self.emit({"type": "group", "name": full_name, "users": users, "computers": computers})
+            else:
                 print("Finding computer sessions for all {} users:".format(full_name))
-                users = bh_data["groups"].users(full_name)
                 for u in users:
-                    print("user {}:".format(u))
-                    computers = set(bh_sessions["sessions"].for_user(u))
-                    for c in computers:
+                    print("user {}:".format(u["user"]))
+                    for c in u["computers"]:
                         print("  {}".format(c))
-            elif params[0] == "computer":
+                print("Sessions on {} computers in all.".format(len(computers)))
+        elif params[0] == "computer":
+            users = sorted(bh_sessions["sessions"].for_computer(full_name))
+            if self.json_output:
+                self.emit({"type": "computer", "name": full_name, "users": users})
+            else:
                 print("Finding all users with sessions on computer {}".format(full_name))
-                users = set(bh_sessions["sessions"].for_computer(full_name))
                 for u in users:
                     print(u)
 
@@ -128,73 +432,585 @@ class BHDCmd(cmd.Cmd):
         supported = ["user", "computer", "group"]
         print("List sessions for the given item.  Syntax:  sessions {} <name>".format("|".join(supported)))
 
+    def do_overlap(self, paramline):
+        params = shlex.split(paramline)
+        if len(params) < 2:
+            self.usage("overlap")
+            return
+
+        group_names = []
+        for param in params:
+            group_name = bh_data["groups"].select_one(param, pick=self.pick)
+            if group_name is None:
+                self.fail("Could not find a group matching name {}".format(param))
+                return
+            group_names.append(group_name)
+        overlap = bh_sessions["sessions"].overlap([bh_data["groups"].users(group_name) for group_name in group_names])
+        if self.json_output:
+            self.emit({"groups": group_names, "computers": overlap})
+        else:
+            print("Computers with sessions from users of both groups (of the group itself on the diagonal):")
+            for i, group_name in enumerate(group_names):
+                print("  {}: {}".format(i, group_name))
+            width = max(len(str(count)) for row in overlap for count in row) + 2
+            print("   " + "".join("{:>{}}".format(i, width) for i in range(len(group_names))))
+            for i, row in enumerate(overlap):
+                print("{:>3}".format(i) + "".join("{:>{}}".format(count, width) for count in row))
+
+    def help_overlap(self):
+        print("Count the computers users of two groups both have sessions on, for every pair of the given groups.  "
+              "Syntax: overlap <group> <group> [<group>...]")
+
+    def do_histogram(self, paramline):
+        params = shlex.split(paramline)
+        if len(params) != 1 or params[0] not in HISTOGRAMS:
+            self.usage("histogram")
+            return
+
+        if params[0] == "sessions":
+            rows = bh_sessions["sessions"].session_rows
+        elif params[0] == "members":
+            rows = bh_data["groups"].member_rows
+        else:
+            rows = bh_data["computers"].admin_rows
+        histograms = []
+        for reverse, (key, label) in enumerate(HISTOGRAMS[params[0]]):
+            histograms.append((key, label, [{"min": fewest, "max": most, "count": count}
+                                            for fewest, most, count in rows(bool(reverse)).histogram()]))
+        if self.json_output:
+            self.emit(dict([("type", params[0])] + [(key, buckets) for key, _, buckets in histograms]))
+            return
+
+        for _, label, buckets in histograms:
+            print("{}:".format(label))
+            for bucket in buckets:
+                if bucket["min"] == bucket["max"]:
+                    print("  {:>13} {}".format(bucket["min"], bucket["count"]))
+                else:
+                    print("  {:>13} {}".format("{}-{}".format(bucket["min"], bucket["max"]), bucket["count"]))
+
+    def help_histogram(self):
+        print("Show how sessions, group memberships or local admin rights are spread out, e.g. how many users have "
+              "sessions on 1, 2-3, 4-7... computers.  Syntax: histogram {}".format("|".join(HISTOGRAMS)))
+
     def do_targets(self, paramline):
         params = shlex.split(paramline)
         if len(params) > 1:
-            self.help_targets()
+            self.usage("targets")
+            return
+
+        if len(params) == 1:
+            max = int(params[0])
         else:
-            if len(params) == 1:
-                max = int(params[0])
-            else:
-                max = 10
-            print("TARGET ANALYSIS")
-            print("===============")
-            print("High Value Groups:")
-            for group in bh_data["groups"].high_value(max):
-                print("  {}".format(group))
-
-            print("Users with the most sessions:")
-            for user in bh_sessions["sessions"].top_users(max):
-                sessions = bh_sessions["sessions"].for_user(user)
-                print("  {}: {}".format(user, len(sessions)))
-
-            print("Computers with the most sessions:")
-            for computer in bh_sessions["sessions"].top_computers(max):
-                sessions = bh_sessions["sessions"].for_computer(computer)
-                print("  {}: {}".format(computer, len(sessions)))
-
-            print("Users with the most direct local admin access:")
-            for user in bh_data["computers"].top_localadmins(max):
-                print("  {}: {}".format(user, len(bh_data["computers"].localadmin_for_user(user))))
+            max = 10
+        sessions = bh_sessions["sessions"]
+        targets = {
+            "max": max,
+            "high_value_groups": bh_data["groups"].high_value(max),
+            "users_by_sessions": [{"name": user, "count": len(sessions.for_user(user))}
+                                  for user in sessions.top_users(max)],
+            "computers_by_sessions": [{"name": computer, "count": len(sessions.for_computer(computer))}
+                                      for computer in sessions.top_computers(max)],
+            "users_by_local_admin": [{"name": user, "count": count}
+                                     for user, count in bh_data["computers"].top_effective(max)],
+            "users_by_remote_desktop": [{"name": user, "count": count}
+                                        for user, count in bh_data["computers"].top_effective(max, remote_desktop=True)],
+            "groups_by_local_admin": [{"name": group, "count": count}
+                                      for group, count in bh_data["computers"].top_effective(max, "group")],
+        }
+        if self.json_output:
+            self.emit(targets)
+            return
+
+        print("TARGET ANALYSIS")
+        print("===============")
+        print("High Value Groups:")
+        for group in targets["high_value_groups"]:
+            print("  {}".format(group))
+
+        print("Users with the most sessions:")
+        for user in targets["users_by_sessions"]:
+            print("  {}: {}".format(user["name"], user["count"]))
+
+        print("Computers with the most sessions:")
+        for computer in targets["computers_by_sessions"]:
+            print("  {}: {}".format(computer["name"], computer["count"]))
+
+        print("Users with local admin access (directly or through groups) to the most computers:")
+        for user in targets["users_by_local_admin"]:
+            print("  {}: {}".format(user["name"], user["count"]))
+
+        print("Users with remote desktop access (directly or through groups) to the most computers:")
+        for user in targets["users_by_remote_desktop"]:
+            print("  {}: {}".format(user["name"], user["count"]))
+
+        print("Groups granting local admin access to the most computers:")
+        for group in targets["groups_by_local_admin"]:
+            print("  {}: {}".format(group["name"], group["count"]))
 
     def help_targets(self):
         print("List top (10) items by active sessions, access, etc... Syntax: targets [<limit>]")
 
+    def do_timing(self, paramline):
+        params = shlex.split(paramline)
+        if len(params) != 1 or params[0] not in ["on", "off"]:
+            self.usage("timing")
+        else:
+            self.timing = params[0] == "on"
+            if self.json_output:
+                self.emit({"timing": self.timing})
+            else:
+                print("Timing is {}.".format(params[0]))
+
+    def help_timing(self):
+        print("Show how long each command takes.  Syntax: timing on|off")
+
+    def do_stats(self, paramline):
+        # Only what is loaded already, so that in lazy mode stats doesn't load everything else.
+        data = already_loaded(bh_data)
+        graph = already_loaded(bh_graph).get("graph")
+        caches = {"name_searches": 0, "compiled_patterns": compile_pattern.cache_info().currsize, "sparse_rows": 0}
+        for owner in list(data.values()) + list(already_loaded(bh_sessions).values()):
+            for cache, size in owner.cache_sizes().items():
+                caches[cache] = caches.get(cache, 0) + size
+        stats = {
+            "load": bh_stats.get("load", {}),
+            "last_search": (graph.counters if graph is not None else None) or {},
+            "caches": caches,
+            "peak_memory_mb": peak_memory_mb(),
+        }
+        if self.json_output:
+            self.emit(stats)
+            return
+
+        load = stats["load"]
+        if load.get("lazy"):
+            print("Loading lazily from {}, loaded so far:".format(load.get("source")))
+        else:
+            print("Loaded from {} in {:.2f}s:".format(load.get("source"), load.get("seconds", 0)))
+        for type_label, file_stats in load.get("files", {}).items():
+            timings = ""
+            if "parse_seconds" in file_stats:
+                timings += ", parsed in {:.2f}s".format(file_stats["parse_seconds"])
+            if "seconds" in file_stats:
+                timings += ", loaded in {:.2f}s".format(file_stats["seconds"])
+            print("  {}: {} objects{}".format(type_label, file_stats.get("objects", 0), timings))
+        if "nodes" in load:
+            print("  trace graph: {} nodes, {} edges".format(load["nodes"], load.get("edges", 0)))
+        for key, label in [("graph_seconds", "Built the trace graph"),
+                           ("effective_access_seconds", "Counted effective access"),
+                           ("name_index_seconds", "Indexed all names")]:
+            if key in load:
+                print("  {} in {:.2f}s".format(label, load[key]))
+        if stats["peak_memory_mb"] is not None and load.get("peak_memory_mb") is not None:
+            print("Peak memory: {:.0f} MB (after loading: {:.0f} MB)".format(stats["peak_memory_mb"],
+                                                                          load["peak_memory_mb"]))
+        elif stats["peak_memory_mb"] is not None:
+            print("Peak memory: {:.0f} MB".format(stats["peak_memory_mb"]))
+        if stats["last_search"]:
+            print("Last {}:".format(stats["last_search"]["command"]))
+            for key, value in sorted(stats["last_search"].items()):
+                if key != "command":
+                    print("  {}: {}".format(key.replace("_", " "), round(value, 4)))
+        print("Caches:")
+        for key, value in sorted(stats["caches"].items()):
+            print("  {}: {}".format(key.replace("_", " "), value))
+
+    def help_stats(self):
+        print("Show load timings, object and edge counts, memory use, cache sizes and the work done by the last "
+              "trace or reach.  Syntax: stats")
+
+    def do_profile(self, paramline):
+        if len(paramline.strip()) == 0:
+            self.usage("profile")
+            return
+        profiler = cProfile.Profile()
+        profiler.runcall(self.onecmd, paramline)
+        if self.json_output:
+            entries = []
+            for (file_name, line, function), (calls, _, own, cumulative, _) in pstats.Stats(profiler).stats.items():
+                entries.append({"function": "{}:{}({})".format(os.path.basename(file_name), line, function),
+                                "calls": calls, "seconds": own, "cumulative": cumulative})
+            entries.sort(key=lambda entry: entry["cumulative"], reverse=True)
+            self.emit({"profile": entries[:PROFILE_LINES]})
+        else:
+            pstats.Stats(profiler, stream=sys.stdout).sort_stats("cumulative").print_stats(PROFILE_LINES)
+
+    def help_profile(self):
+        print("Run a command under the Python profiler and show where the time went.  Syntax: profile <command>")
+
+
+# Server mode.  Each query line sent to the server is answered with a line holding the length in bytes of the answer,
+# followed by the answer: the command's output, as it would be printed in batch mode (or at the prompt, after
+# "format text").
+DEFAULT_WORKERS = 4
+DEFAULT_TIMEOUT = 60.0
+WRITE_COMMANDS = ["reload"]
+# What socket clients may run.  reload replaces the loaded data, so it needs --allow-reload, and export writes files, so
+# it needs --export-dir.
+READ_COMMANDS = ["describe", "help", "histogram", "list", "overlap", "reach", "sessions", "stats", "targets", "timing",
+                 "trace"]
+
+
+def parse_address(address):
+    # host:port (or just a port) for TCP on that interface, anything else is the path of a Unix socket.
+    host, _, port = address.rpartition(":")
+    if port.isdigit() and "/" not in address:
+        return (host or "127.0.0.1", int(port))
+    return address
+
+
+class ReadWriteLock:
+    # Any number of readers, or a single writer.  Waiting writers go first, so a steady stream of queries can't hold
+    # off a reload for ever.
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    @contextlib.contextmanager
+    def reading(self):
+        with self.condition:
+            while self.writer or self.waiting_writers > 0:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def writing(self):
+        with self.condition:
+            self.waiting_writers += 1
+            while self.writer or self.readers > 0:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = False
+                self.condition.notify_all()
+
+
+class QueryRunner:
+    # Runs queries from every connection on a fixed pool of threads.  Queries only read the loaded data and run side
+    # by side; a reload waits for them to finish and holds off new ones until it is done.
+    def __init__(self, workers, timeout, pick, allow_reload=False, export_dir=None):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.lock = ReadWriteLock()
+        self.timeout = timeout
+        self.pick = pick
+        self.export_dir = export_dir
+        self.allowed = READ_COMMANDS + (WRITE_COMMANDS if allow_reload else []) + (["export"] if export_dir else [])
+
+    def settings(self):
+        return {"json_output": True, "pick": self.pick, "timeout": self.timeout, "timing": False}
+
+    @staticmethod
+    def answer(line, settings, **result):
+        if settings["json_output"]:
+            return json.dumps(dict(query=line, **result)) + "\n"
+        return "{}\n".format(result.get("error", result.get("message")))
+
+    # format, pick and timeout change how this connection's later queries are run.
+    def configure(self, line, params, settings):
+        if len(params) != 2:
+            return self.answer(line, settings, error="Syntax: format json|text, pick exact|first or timeout <seconds>")
+        if params[0] == "format" and params[1] in ["json", "text"]:
+            settings["json_output"] = params[1] == "json"
+        elif params[0] == "pick" and params[1] in ["exact", "first"]:
+            settings["pick"] = params[1]
+        elif params[0] == "timeout":
+            settings["timeout"] = float(params[1])
+        else:
+            return self.answer(line, settings, error="Invalid value for {}: {}".format(params[0], params[1]))
+        return self.answer(line, settings, message="{} is {}.".format(params[0].capitalize(), params[1]),
+                           **{params[0]: params[1]})
+
+    # The command a line runs, the way BHDCmd reads it ("?" is help, profile runs the command after it).
+    @staticmethod
+    def command(line):
+        parser = cmd.Cmd()
+        command, arg, _ = parser.parseline(line)
+        while command == "profile" and arg:
+            command, arg, _ = parser.parseline(arg)
+        return command
+
+    def execute(self, line, settings):
+        interpreter = BHDCmd(pick=settings["pick"], json_output=settings["json_output"])
+        interpreter.timing = settings["timing"]
+        # Traces stop looking by themselves when the query timeout is up, and answer with the paths found so far.
+        interpreter.trace_timeout = settings["timeout"] or None
+        interpreter.export_dir = self.export_dir
+        lock = self.lock.writing() if self.command(line) in WRITE_COMMANDS else self.lock.reading()
+        with lock, redirect_output(io.StringIO()) as output:
+            line = interpreter.precmd(line)
+            try:
+                interpreter.postcmd(interpreter.onecmd(line), line)
+            except SystemExit:
+                interpreter.fail("Use exit to close the connection.")
+            except Exception as e:
+                interpreter.fail("Query failed: {}: {}".format(type(e).__name__, e))
+        return interpreter.timing, output.getvalue()
+
+    def run(self, line, settings):
+        try:
+            params = shlex.split(line)
+        except ValueError as e:
+            return self.answer(line, settings, error="Invalid value: {}".format(e))
+        if len(params) == 0:
+            return ""
+        if params[0] in ["format", "pick", "timeout"]:
+            try:
+                return self.configure(line, params, settings)
+            except ValueError as e:
+                return self.answer(line, settings, error="Invalid value: {}".format(e))
+        command = self.command(line)
+        if command not in self.allowed:
+            return self.answer(line, settings, error="{} is not available on this server.".format(command or params[0]))
+
+        future = self.pool.submit(self.execute, line, dict(settings))
+        try:
+            # Traces bound themselves (see execute), so their partial answer isn't replaced by a timeout error.
+            timeout = None if command == "trace" else settings["timeout"] or None
+            settings["timing"], output = future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            # A query still waiting for a worker is dropped.  One that has started can't be stopped: it keeps its
+            # worker (and the read lock) until it finishes, and only its answer is thrown away.
+            future.cancel()
+            return self.answer(line, settings, error="Query timed out after {}s.".format(settings["timeout"]))
+        return output
+
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        settings = self.server.runner.settings()
+        try:
+            for raw_line in self.rfile:
+                line = raw_line.decode("utf-8", "replace").strip()
+                if line in ["exit", "quit", "EOF"]:
+                    break
+                answer = self.server.runner.run(line, settings).encode("utf-8")
+                self.wfile.write("{}\n".format(len(answer)).encode("ascii") + answer)
+                self.wfile.flush()
+        except ConnectionError:
+            pass
+
+
+class TCPQueryServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, "UnixStreamServer"):
+    class UnixQueryServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+def serve(address, workers, timeout, pick, allow_reload=False, export_dir=None):
+    address = parse_address(address)
+    if isinstance(address, str):
+        if not hasattr(socketserver, "UnixStreamServer"):
+            print("Unix sockets are not available here, use <host>:<port> instead.")
+            sys.exit(1)
+        # A socket left behind by a server that didn't shut down cleanly; never remove anything else.
+        if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+            os.remove(address)
+        server = UnixQueryServer(address, QueryHandler)
+    else:
+        server = TCPQueryServer(address, QueryHandler)
+    server.runner = QueryRunner(workers, timeout, pick, allow_reload, export_dir)
+    sys.stdout = ThreadOutput(sys.stdout)
+
+    # kill (and service managers) stop the server the same way Ctrl-C does, so a Unix socket isn't left behind.
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, stop)
+    print("Serving queries on {} with {} workers.  Press Ctrl-C to stop.".format(
+        address if isinstance(address, str) else "{}:{}".format(*address), workers))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping...")
+    finally:
+        server.server_close()
+        server.runner.pool.shutdown(wait=False)
+        if isinstance(address, str) and os.path.exists(address):
+            os.remove(address)
+
+
+class QueryClient:
+    def __init__(self, address):
+        address = parse_address(address)
+        if isinstance(address, str):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(address)
+        else:
+            self.socket = socket.create_connection(address)
+        self.file = self.socket.makefile("rwb")
+
+    def query(self, line):
+        self.file.write(line.encode("utf-8") + b"\n")
+        self.file.flush()
+        length = self.file.readline()
+        if len(length) == 0:
+            raise ConnectionError("The server closed the connection.")
+        return self.file.read(int(length)).decode("utf-8")
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+class RemoteCmd(cmd.Cmd):
+    # The prompt for --connect.  Lines are sent to the server as they are, so the commands are the same as BHDCmd's.
+    def __init__(self, client):
+        cmd.Cmd.__init__(self)
+        self.prompt = 'elementary> '
+        self.intro = "Type 'help' for a list of commands."
+        self.client = client
+
+    def onecmd(self, line):
+        line = line.strip()
+        if line in ["exit", "quit", "EOF"]:
+            print("Exiting...")
+            return True
+        print(self.client.query(line), end="")
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Bloodhound Elementary - analyzer for bloodhound .json files.')
-    parser.add_argument('path', help="The file path to the folder containing the .json files from running Bloodhound.")
+    parser.add_argument('path', nargs='*',
+                        help="The folder containing the .json files from running Bloodhound.  Several folders, files "
+                             "or globs (e.g. 'collections/2019*') are merged into one data set.")
+    parser.add_argument('--rebuild', action='store_true',
+                        help="Ignore the saved snapshot, re-parse the .json files and write a fresh snapshot.")
+    parser.add_argument('--no-snapshot', action='store_true',
+                        help="Neither read nor write the {} file in the data folder.".format(SNAPSHOT_FILE))
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="Parse the .json files in this many processes (default: 1 for a single collection, "
+                             "otherwise one per CPU).")
+    parser.add_argument('-c', '--command', action='append', default=[],
+                        help="Run this command and exit instead of starting the prompt.  May be given more than once.")
+    parser.add_argument('--batch', metavar='FILE',
+                        help="Run the commands in FILE (one per line, '-' for stdin) and exit.")
+    parser.add_argument('--pick', choices=['exact', 'first'], default='exact',
+                        help="How -c/--batch resolve a name matching several objects: only an exact match (default) "
+                             "or the first, best ranked, match.")
+    parser.add_argument('--lazy', action='store_true',
+                        help="Don't load anything up front: each .json file is read the first time a command needs "
+                             "it, and describe reads objects back from the files.  Snapshots aren't used.")
+    parser.add_argument('--serve', metavar='ADDRESS',
+                        help="Load the data once and answer queries on ADDRESS, a Unix socket path or <host>:<port>, "
+                             "instead of starting the prompt.")
+    parser.add_argument('--connect', metavar='ADDRESS',
+                        help="Send commands (from the prompt, -c or --batch) to a server started with --serve.")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help="Number of queries --serve runs at the same time (default: {}).".format(DEFAULT_WORKERS))
+    parser.add_argument('--timeout', type=float,
+                        help="Give up on a query after this many seconds (default for --serve: {:.0f}, 0 for no "
+                             "limit).".format(DEFAULT_TIMEOUT))
+    parser.add_argument('--allow-reload', action='store_true',
+                        help="Let --serve clients run reload.  Only the read-only query commands are served otherwise.")
+    parser.add_argument('--export-dir', metavar='DIR',
+                        help="Let --serve clients run export, writing only to files directly in DIR.")
 
     args = parser.parse_args()
-    if args.path[-1] == '/':
-        path = args.path
-    else:
-        path = "{}/".format(args.path)
+    batch = len(args.command) > 0 or args.batch is not None
+    if args.connect is None and len(args.path) == 0:
+        parser.error("the following arguments are required: path")
+    if args.serve is not None and batch:
+        parser.error("--serve can't be combined with -c or --batch")
+    if args.export_dir is not None and not os.path.isdir(args.export_dir):
+        parser.error("--export-dir {} is not a folder".format(args.export_dir))
 
-    # Pre-checks - make sure all the files we need exist before we continue.
-    if os.path.isdir(path):
+    if args.connect is not None:
+        try:
+            client = QueryClient(args.connect)
+        except OSError as e:
+            print("Could not connect to {}: {}".format(args.connect, e))
+            sys.exit(1)
+        client.query("pick {}".format(args.pick))
+        if args.timeout is not None:
+            client.query("timeout {}".format(args.timeout))
+        if batch:
+            lines = list(args.command)
+            if args.batch == '-':
+                lines += sys.stdin.readlines()
+            elif args.batch is not None:
+                with open(args.batch) as batch_file:
+                    lines += batch_file.readlines()
+            for line in lines:
+                line = line.strip()
+                if line in ["exit", "quit"]:
+                    break
+                if len(line) > 0 and not line.startswith("#"):
+                    print(client.query(line), end="")
+                    sys.stdout.flush()
+        else:
+            client.query("format text")
+            RemoteCmd(client).cmdloop()
+        client.close()
+        sys.exit(0)
+
+    # In batch mode stdout only carries the JSON lines, everything else goes to stderr.
+    with contextlib.redirect_stdout(sys.stderr if batch else sys.stdout):
+        # Pre-checks - make sure all the files we need exist before we continue.
+        for path in args.path:
+            if len(glob.glob(path)) == 0:
+                print("The path to your bloodhound files does not exist: {}".format(path))
+                sys.exit(1)
+        files = find_collection_files(args.path)
         missing_files = False
-        for file in ['computers.json', 'domains.json', 'groups.json', 'sessions.json', 'users.json']:
-            if not os.path.exists("{}{}".format(path, file)):
-                print('It looks like the file {} is missing from your specified folder.'.format(file))
+        for file in COLLECTION_FILES:
+            if len(files[file[:-5]]) == 0:
+                if len(args.path) == 1 and os.path.isdir(args.path[0]):
+                    print('It looks like the file {} is missing from your specified folder.'.format(file))
+                else:
+                    print('None of the specified paths has a {} file.'.format(file))
                 missing_files = True
         if missing_files:
             print("Cannot continue with missing files!")
+            sys.exit(1)
         else:
             print("Starting Bloodhound Elementary...")
-    else:
-        print("The path to your bloodhound files does not exist: {}".format(path))
 
-    bh_data["computers"] = Computers("{}computers.json".format(path))
-    bh_data["domains"] = Domains("{}domains.json".format(path))
-    bh_data["groups"] = Groups("{}groups.json".format(path))
-    bh_data["users"] = Users("{}users.json".format(path))
+        source_files = collection_file_list(files)
+        if len(source_files) > len(COLLECTION_FILES):
+            print("Merging {} files from {} paths.".format(len(source_files), len(args.path)))
+        jobs = args.jobs
+        if jobs is None:
+            jobs = 1 if len(source_files) == len(COLLECTION_FILES) else min(os.cpu_count() or 1, len(source_files))
+        snapshot_file = snapshot_path(args.path, source_files)
+        if args.lazy:
+            defer_collection(files)
+            print("Files will be loaded as they are needed.")
+        elif args.no_snapshot or args.rebuild or not load_snapshot(snapshot_file, source_files):
+            load_collection(files, jobs)
+            if not args.no_snapshot:
+                try:
+                    save_snapshot(snapshot_file, source_files)
+                except OSError as e:
+                    print("Could not write the snapshot: {}".format(e))
 
-    types_singular = []
-    for key in bh_data.keys():
-        types_singular.append(key[:-1])
-
-    bh_sessions["sessions"] = Sessions("{}sessions.json".format(path))
-
-    interpreter = BHDCmd()
-    interpreter.cmdloop()
+    if args.serve is not None:
+        serve(args.serve, args.workers, DEFAULT_TIMEOUT if args.timeout is None else args.timeout, args.pick,
+              args.allow_reload, args.export_dir)
+    elif batch:
+        interpreter = BHDCmd(pick=args.pick, json_output=True)
+        interpreter.run_batch(args.command)
+        if args.batch == '-':
+            interpreter.run_batch(sys.stdin)
+        elif args.batch is not None:
+            with open(args.batch) as batch_file:
+                interpreter.run_batch(batch_file)
+    else:
+        interpreter = BHDCmd()
+        interpreter.cmdloop()
@@ -1,93 +1,1133 @@
+import bisect
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import gc
+import glob
+import hashlib
+import heapq
 import json
+import os
 import re
-from collections import deque
+import sys
+import threading
+import time
+import zipfile
+from array import array
 
-bh_data = {}
-bh_sessions = {}
+try:
+    import resource
+except ImportError:
+    resource = None
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-class TraceHistory:
+
+# Peak resident memory of this process, or None where the resource module doesn't exist (Windows).
+def peak_memory_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class ThreadOutput:
+    # Stands in for sys.stdout while serving, so that each query's prints go to that query's own buffer while other
+    # threads (and the server's own messages) still reach the real stdout.
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def target(self):
+        stream = getattr(self.local, "stream", None)
+        return self.stream if stream is None else stream
+
+    def write(self, text):
+        return self.target().write(text)
+
+    def flush(self):
+        self.target().flush()
+
+    @contextlib.contextmanager
+    def redirect(self, stream):
+        previous = getattr(self.local, "stream", None)
+        self.local.stream = self.target() if stream is self else stream
+        try:
+            yield stream
+        finally:
+            self.local.stream = previous
+
+
+# contextlib.redirect_stdout swaps sys.stdout for every thread, which would mix up concurrent queries' output.
+@contextlib.contextmanager
+def redirect_output(stream):
+    if isinstance(sys.stdout, ThreadOutput):
+        with sys.stdout.redirect(stream):
+            yield stream
+    else:
+        with contextlib.redirect_stdout(stream):
+            yield stream
+
+
+# Loads run one at a time, whichever thread asks first: the name table can't take two loaders interning at once.
+LOAD_LOCK = threading.RLock()
+
+
+class Deferred:
+    def __init__(self, load):
+        self.load = load
+
+
+# bh_data, bh_sessions and bh_graph.  In lazy mode their values start out Deferred and are loaded the first time they
+# are looked up; progress messages go to stderr so they never end up in a command's output.
+class LazyDict(dict):
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if isinstance(value, Deferred):
+            with LOAD_LOCK:
+                value = dict.__getitem__(self, key)
+                if isinstance(value, Deferred):
+                    with redirect_output(sys.stderr):
+                        value = value.load()
+                    self[key] = value
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+
+# What has been loaded so far, without loading anything else.
+def already_loaded(store):
+    return dict((key, value) for key, value in dict.items(store) if not isinstance(value, Deferred))
+
+
+bh_data = LazyDict()
+bh_sessions = LazyDict()
+bh_graph = LazyDict()
+bh_stats = {}
+
+
+READ_SIZE = 1 << 20
+PROGRESS_MIN_SIZE = 32 * READ_SIZE
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+# What may follow the digits of a number that is still going, e.g. "1." or "6e" cut off by the end of a read.
+NUMBER_CONTINUES = ".eE"
+
+
+# Incremental reader over a binary file.  Only the bytes needed to decode the current value are kept in memory, so
+# multi-gigabyte collections can be walked one object at a time.
+class JsonStream:
+
+    # With track_offsets the byte offset of any buffer position can be had from byte_offset(), at the cost of
+    # encoding the text back as it is consumed.
+    def __init__(self, f, label, total_size=0, track_offsets=False):
+        self._file = f
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+        self._head = b""
+        self.label = label
+        self.total_size = total_size
+        self.bytes_read = 0
+        self._next_progress = 10
+        self.track_offsets = track_offsets
+        self._mark = 0
+        self._mark_offset = 0
+
+    def _fill(self):
+        chunk = self._file.read(READ_SIZE)
+        # The byte order mark can be split over reads too.
+        if self.bytes_read < len(codecs.BOM_UTF8):
+            self._head += chunk
+            if self._head.startswith(codecs.BOM_UTF8):
+                self._mark_offset = len(codecs.BOM_UTF8)
+        self.bytes_read += len(chunk)
+        if len(chunk) == 0:
+            self._eof = True
+        if self._pos > READ_SIZE:
+            if self.track_offsets:
+                self.byte_offset(self._pos)
+                self._mark = 0
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+        self._buffer += self._text_decoder.decode(chunk, final=self._eof)
+        self._report_progress()
+
+    # Positions must be asked for in increasing order.
+    def byte_offset(self, pos):
+        self._mark_offset += len(self._buffer[self._mark:pos].encode("utf-8"))
+        self._mark = pos
+        return self._mark_offset
+
+    def _report_progress(self):
+        if self.total_size >= PROGRESS_MIN_SIZE:
+            percent = self.bytes_read * 100 // self.total_size
+            if percent >= self._next_progress:
+                print("  ...read {}% of {} ({} MB)".format(percent, self.label, self.bytes_read >> 20))
+                self._next_progress = percent - percent % 10 + 10
+
+    def _skip_whitespace(self):
+        while True:
+            self._pos = WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or self._eof:
+                return
+            self._fill()
+
+    def next_char(self):
+        char = self.peek_char()
+        self._pos += len(char)
+        return char
+
+    def peek_char(self):
+        self._skip_whitespace()
+        return self._buffer[self._pos:self._pos + 1]
+
+    def expect(self, expected):
+        char = self.next_char()
+        if char != expected:
+            raise ValueError("Malformed {}: expected '{}' but found '{}'".format(self.label, expected, char))
+
+    # A number decodes from a prefix of itself ("638201." as 638201), so it only counts as complete once something
+    # that can't continue it has been read.
+    @staticmethod
+    def _complete(value, buffer, end):
+        if end == len(buffer):
+            return False
+        return type(value) not in (int, float) or buffer[end] not in NUMBER_CONTINUES
+
+    def decode(self):
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # A value that runs right up to the end of the buffer may continue in the next read.
+                if self._eof or self._complete(value, self._buffer, end):
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+            self._fill()
+
+    # Same as calling decode() and next_char() per element, but stays on the fast path while the whole element and
+    # its separator are already buffered.  With spans each element comes with the byte offsets of its start and end.
+    def iter_array(self, spans=False):
+        match = WHITESPACE.match
+        raw_decode = self._decoder.raw_decode
+        while True:
+            buffer = self._buffer
+            try:
+                start = match(buffer, self._pos).end()
+                value, end = raw_decode(buffer, start)
+                separator = match(buffer, end).end()
+                if type(value) in (int, float) and not self._complete(value, buffer, end):
+                    separator = len(buffer)
+            except ValueError:
+                separator = len(buffer)
+            if separator < len(buffer):
+                if spans:
+                    value = (value, self.byte_offset(start), self.byte_offset(end))
+                self._pos = separator + 1
+                yield value
+                if buffer[separator] != ",":
+                    return
+            else:
+                if spans:
+                    self._skip_whitespace()
+                    start = self.byte_offset(self._pos)
+                    value = self.decode()
+                    yield value, start, self.byte_offset(self._pos)
+                else:
+                    yield self.decode()
+                if self.next_char() != ",":
+                    return
+
+
+# Members of a zip file (e.g. SharpHound output) are read in place and named "<zip file>::<member>".
+ZIP_SEPARATOR = "::"
+
+
+def split_source(json_file):
+    if ZIP_SEPARATOR in json_file:
+        archive_name, member = json_file.split(ZIP_SEPARATOR, 1)
+        return archive_name, member
+    return json_file, None
+
+
+# A binary file object and the uncompressed size of a json file or zip member.  Zip members are decompressed as they
+# are read, so nothing is ever extracted to disk.
+@contextlib.contextmanager
+def open_source(json_file):
+    archive_name, member = split_source(json_file)
+    if member is None:
+        with open(json_file, 'rb') as f:
+            yield f, os.path.getsize(json_file)
+    else:
+        with zipfile.ZipFile(archive_name) as archive:
+            info = archive.getinfo(member)
+            with archive.open(info) as f:
+                yield f, info.file_size
+
+
+class MissingArray(ValueError):
+    pass
+
+
+# With required, a file that doesn't have the array at all (e.g. some other type of collection file) raises
+# MissingArray instead of reading as an empty one.
+def iter_json_array(json_file, key, spans=False, required=False):
+    with open_source(json_file) as (f, size):
+        stream = JsonStream(f, os.path.basename(json_file), size, track_offsets=spans)
+        stream.expect("{")
+        while stream.peek_char() != "}":
+            name = stream.decode()
+            stream.expect(":")
+            if name == key and stream.peek_char() == "[":
+                stream.expect("[")
+                if stream.peek_char() != "]":
+                    for value in stream.iter_array(spans):
+                        yield value
+                return
+            stream.decode()
+            if stream.next_char() != ",":
+                break
+    if required:
+        raise MissingArray("{} has no {} array".format(json_file, key))
+
+
+class NameTable:
 
     def __init__(self):
-        self._users = set([])
-        self._groups = set([])
-        self._computers = set([])
+        self._ids = {}
+        self.names = []
+
+    def intern(self, name):
+        name_id = self._ids.get(name)
+        if name_id is None:
+            name_id = len(self.names)
+            self._ids[name] = name_id
+            self.names.append(name)
+        return name_id
+
+    def canonical(self, name):
+        return self.names[self.intern(name)]
 
-    def add_user(self, user):
-        self._users.add(user)
+    def reset(self, names):
+        self.names = names
+        self._ids = {name: name_id for name_id, name in enumerate(names)}
 
-    def dedupe_users(self, user_set):
-        user_set.difference_update(self._users)
-        self._users.update(user_set)
 
-    def add_group(self, group):
-        self._groups.add(group)
+bh_names = NameTable()
 
-    def dedupe_groups(self, group_set):
-        group_set.difference_update(self._groups)
-        self._groups.update(group_set)
+# Principal types are packed into the low bits of record edge arrays, i.e. (name_id << 2) | code.
+PRINCIPAL_CODES = {"user": 0, "group": 1, "computer": 2}
+PRINCIPAL_NAMES = ["User", "Group", "Computer", "Unknown"]
 
-    def add_computer(self, computer):
-        self._computers.add(computer)
 
-    def dedupe_computers(self, computer_set):
-        computer_set.difference_update(self._computers)
-        self._computers.update(computer_set)
+def pack_principals(entries, name_key, type_key):
+    packed = array("i")
+    for entry in entries:
+        name = entry.get(name_key)
+        if name is not None:
+            packed.append((bh_names.intern(name) << 2) | PRINCIPAL_CODES.get(entry.get(type_key, "").lower(), 3))
+    return packed
 
-    def copy(self):
-        the_copy = TraceHistory()
-        the_copy._users = self._users.copy()
-        the_copy._groups = self._groups.copy()
-        the_copy._computers = self._computers.copy()
-        return the_copy
+
+def unpack_principals(packed, name_key, type_key, lower=False):
+    entries = []
+    for entry in packed:
+        principal_type = PRINCIPAL_NAMES[entry & 3]
+        entries.append({name_key: bh_names.names[entry >> 2],
+                        type_key: principal_type.lower() if lower else principal_type})
+    return entries
+
+
+# Many small arrays flattened into one (offsets, values) pair, so snapshots and worker processes hand over two arrays.
+def pack_arrays(arrays):
+    offsets = array("i", [0])
+    values = array("i")
+    for packed in arrays:
+        values.extend(packed)
+        offsets.append(len(values))
+    return offsets, values
+
+
+def unpack_arrays(offsets, values):
+    return [values[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
+# A relationship as compressed sparse rows over name ids: the columns of row r are values[offsets[r]:offsets[r + 1]],
+# without duplicates and sorted by name.  Both are plain array("i"); when NumPy is installed the bulk operations run
+# over them without copying, otherwise they fall back to sets.
+class SparseRows:
+    def __init__(self, rows, columns):
+        names = bh_names.names
+        row_count = max(rows) + 1 if len(rows) > 0 else 0
+        self.offsets = array("i")
+        self.values = array("i")
+        self._names = None
+        if numpy is not None and len(rows) > 0:
+            rows = numpy.frombuffer(rows, dtype=numpy.intc).astype(numpy.int64)
+            columns = numpy.frombuffer(columns, dtype=numpy.intc)
+            order = numpy.array(sorted(numpy.unique(columns).tolist(), key=names.__getitem__), dtype=numpy.intc)
+            rank = numpy.zeros(int(order.max()) + 1, dtype=numpy.int64)
+            rank[order] = numpy.arange(len(order))
+            # One sorted key per pair, so a single unique() both drops duplicates and orders rows and columns.
+            keys = numpy.unique(rows * len(order) + rank[columns])
+            offsets = numpy.searchsorted(keys // len(order), numpy.arange(row_count + 1))
+            self.offsets.frombytes(offsets.astype(numpy.intc).tobytes())
+            self.values.frombytes(order[keys % len(order)].tobytes())
+        else:
+            order = sorted(set(columns), key=names.__getitem__)
+            rank = dict((column, position) for position, column in enumerate(order))
+            self.offsets.append(0)
+            for key in sorted(set(row * len(order) + rank[column] for row, column in zip(rows, columns))):
+                row, position = divmod(key, len(order))
+                while len(self.offsets) <= row:
+                    self.offsets.append(len(self.values))
+                self.values.append(order[position])
+            while len(self.offsets) <= row_count:
+                self.offsets.append(len(self.values))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _numpy(self):
+        return numpy.frombuffer(self.offsets, dtype=numpy.intc), numpy.frombuffer(self.values, dtype=numpy.intc)
+
+    def rows(self, rows, values=None):
+        offsets = self.offsets
+        values = self.values if values is None else values
+        count = len(offsets) - 1
+        return [values[offsets[row]:offsets[row + 1]] if row < count else values[:0] for row in rows]
+
+    # Like rows, with the columns' names.  The names of every column are looked up once and kept, so after that each
+    # row is a single slice.
+    def row_names(self, rows):
+        if self._names is None:
+            self._names = list(map(bh_names.names.__getitem__, self.values))
+        return self.rows(rows, self._names)
+
+    # The same relationship the other way round, e.g. computer -> users for user -> computers.
+    def transpose(self):
+        rows = array("i")
+        if numpy is not None:
+            offsets = self._numpy()[0]
+            rows.frombytes(numpy.repeat(numpy.arange(len(self), dtype=numpy.intc), numpy.diff(offsets)).tobytes())
+        else:
+            for row in range(len(self)):
+                rows.extend([row] * (self.offsets[row + 1] - self.offsets[row]))
+        return SparseRows(self.values, rows)
+
+    # Distinct columns of all the given rows, in no particular order.
+    def union(self, rows):
+        if numpy is not None and len(self.values) > 0:
+            rows = [row for row in rows if row < len(self)]
+            offsets, values = self._numpy()
+            rows = numpy.array(rows, dtype=numpy.int64)
+            starts = offsets[rows]
+            lengths = offsets[rows + 1] - starts
+            # Each row's start repeated once per column, plus 0, 1, 2... within the row.
+            index = numpy.repeat(starts - numpy.cumsum(lengths) + lengths, lengths) + numpy.arange(lengths.sum())
+            return numpy.unique(values[index]).tolist()
+        return list(set().union(*self.rows(rows)))
+
+    # For lists of rows A and B, the number of columns any row of A shares with any row of B, for every pair of lists.
+    def overlap(self, row_lists):
+        unions = [self.union(rows) for rows in row_lists]
+        if numpy is not None and sum(len(columns) for columns in unions) > 0:
+            columns, inverse = numpy.unique(numpy.concatenate([numpy.array(columns, dtype=numpy.intc)
+                                                               for columns in unions]), return_inverse=True)
+            incidence = numpy.zeros((len(unions), len(columns)), dtype=numpy.int64)
+            incidence[numpy.repeat(numpy.arange(len(unions)), [len(columns) for columns in unions]), inverse] = 1
+            return (incidence @ incidence.T).tolist()
+        unions = [set(columns) for columns in unions]
+        return [[len(first & second) for second in unions] for first in unions]
+
+    # How many rows have 1, 2-3, 4-7, 8-15... columns, as (fewest, most, rows) for each non-empty bucket.  Empty rows
+    # are left out, as most name ids belong to other types of object.
+    def histogram(self):
+        if numpy is not None and len(self) > 0:
+            degrees = numpy.diff(self._numpy()[0])
+            buckets = enumerate(numpy.bincount(numpy.frexp(degrees[degrees > 0])[1]).tolist())
+        else:
+            buckets = sorted(collections.Counter((self.offsets[row + 1] - self.offsets[row]).bit_length()
+                                                 for row in range(len(self))).items())
+        return [(1 << bucket - 1, (1 << bucket) - 1, rows) for bucket, rows in buckets if bucket > 0 and rows > 0]
+
+
+# Everything that is only needed by describe is kept as compact encoded JSON and decoded on demand.  In lazy mode
+# it isn't kept at all: source is the (json file, start, end) byte span of the object, which is read back instead.
+class Record:
+    __slots__ = ("name_id", "_details")
+    array_slots = ()
+    value_slots = ()
+    # Keys of the original object that details() fills back in from slots.
+    slot_keys = ()
+
+    def __init__(self, name_id, obj, source=None):
+        self.name_id = name_id
+        obj.pop("Name", None)
+        if source is None:
+            self._details = json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+        else:
+            self._details = source
+
+    @property
+    def name(self):
+        return bh_names.names[self.name_id]
+
+    def details(self):
+        if isinstance(self._details, tuple):
+            try:
+                obj = read_object(*self._details)
+            except ValueError:
+                obj = None
+            if not isinstance(obj, dict) or obj.get("Name") != self.name:
+                raise ValueError("{} has changed since it was loaded, restart Elementary to describe {}".format(
+                    self._details[0], self.name))
+            for key in ("Name",) + self.slot_keys:
+                obj.pop(key, None)
+        else:
+            obj = json.loads(self._details.decode("utf-8"))
+        obj["Name"] = self.name
+        return obj
+
+    # Column-wise form of a list of records, used for snapshots.
+    @classmethod
+    def pack(cls, records):
+        columns = {"name_id": array("i", (record.name_id for record in records)),
+                   "_details": [record._details for record in records]}
+        for slot in cls.array_slots:
+            columns[slot] = pack_arrays(getattr(record, slot) for record in records)
+        for slot in cls.value_slots:
+            columns[slot] = [getattr(record, slot) for record in records]
+        return columns
+
+    # Rewrites name ids in packed columns from another name table (e.g. a worker process) into this one.
+    @classmethod
+    def remap(cls, columns, remap):
+        columns["name_id"] = array("i", (remap[name_id] for name_id in columns["name_id"]))
+        for slot in cls.array_slots:
+            offsets, values = columns[slot]
+            columns[slot] = (offsets, array("i", ((remap[value >> 2] << 2) | (value & 3) for value in values)))
+        return columns
+
+    # Folds in an older record for the same object from another collection: the newer details win, while ACEs and
+    # members from both are kept (once each).
+    def merge(self, older):
+        for slot in self.array_slots:
+            setattr(self, slot, array("i", dict.fromkeys(getattr(older, slot) + getattr(self, slot))))
+        for slot in self.value_slots:
+            setattr(self, slot, getattr(self, slot) or getattr(older, slot))
+        return self
+
+    @classmethod
+    def unpack(cls, columns):
+        records = [cls.__new__(cls) for _ in range(len(columns["name_id"]))]
+        for slot in ("name_id", "_details") + cls.value_slots:
+            for record, value in zip(records, columns[slot]):
+                setattr(record, slot, value)
+        for slot in cls.array_slots:
+            for record, value in zip(records, unpack_arrays(*columns[slot])):
+                setattr(record, slot, value)
+        return records
+
+
+class ComputerRecord(Record):
+    __slots__ = ("local_admins", "remote_desktop_users")
+    array_slots = __slots__
+    slot_keys = ("LocalAdmins", "RemoteDesktopUsers")
+
+    def __init__(self, name_id, obj, source=None):
+        self.local_admins = pack_principals(obj.pop("LocalAdmins", None) or [], "Name", "Type")
+        self.remote_desktop_users = pack_principals(obj.pop("RemoteDesktopUsers", None) or [], "Name", "Type")
+        super().__init__(name_id, obj, source)
+
+    def details(self):
+        obj = super().details()
+        obj["LocalAdmins"] = unpack_principals(self.local_admins, "Name", "Type")
+        obj["RemoteDesktopUsers"] = unpack_principals(self.remote_desktop_users, "Name", "Type")
+        return obj
+
+
+class GroupRecord(Record):
+    __slots__ = ("members", "highvalue")
+    array_slots = ("members",)
+    value_slots = ("highvalue",)
+    slot_keys = ("Members",)
+
+    def __init__(self, name_id, obj, source=None):
+        self.members = pack_principals(obj.pop("Members", None) or [], "MemberName", "MemberType")
+        self.highvalue = bool((obj.get("Properties") or {}).get("highvalue", False))
+        super().__init__(name_id, obj, source)
+
+    def details(self):
+        obj = super().details()
+        obj["Members"] = unpack_principals(self.members, "MemberName", "MemberType", lower=True)
+        return obj
+
+
+# Edge kinds are packed into the low bits of each adjacency entry, i.e. (node_id << 2) | kind.
+MEMBER_OF = 0
+ADMIN_TO = 1
+HAS_SESSION = 2
+EDGE_LABELS = ["MemberOf", "AdminTo", "HasSession"]
+PRINCIPAL_TYPES = {"user": "users", "group": "groups", "computer": "computers"}
+# Node types in the order of their codes in snapshots.
+NODE_TYPES = ("users", "groups", "computers")
+
+
+class TraceGraph:
+    # Work done by the last trace or reach, for the stats command.
+    counters = None
+
+    def __init__(self, data, sessions):
+        print("Building trace graph...")
+        self._ids = dict((type_label, {}) for type_label in NODE_TYPES)
+        self._nodes = []
+        self._out = []
+        self._in = []
+        self.edge_count = 0
+
+        for type_label in NODE_TYPES:
+            for name in data[type_label].data_dict.keys():
+                self.node_id(type_label, name)
+
+        for member_type, memberships in data["groups"].parents.items():
+            if member_type in PRINCIPAL_TYPES:
+                for member_name, groups in memberships.items():
+                    member_id = self.node_id(PRINCIPAL_TYPES[member_type], member_name)
+                    for group_name in groups:
+                        self._add_edge(member_id, self.node_id("groups", group_name), MEMBER_OF)
+
+        for principal, computers in data["computers"].admin_index.items():
+            admin_type = PRINCIPAL_TYPES.get(data["computers"].principal_types[principal].lower())
+            if admin_type is not None:
+                admin_id = self.node_id(admin_type, principal)
+                for computer_name in computers:
+                    self._add_edge(admin_id, self.node_id("computers", computer_name), ADMIN_TO)
+
+        for computer_name, users in sessions.data_dict["computers"].items():
+            computer_id = self.node_id("computers", computer_name)
+            for user in users:
+                self._add_edge(computer_id, self.node_id("users", user), HAS_SESSION)
+
+        # Collections frequently repeat ACEs and sessions, so drop duplicate edges once everything is in.
+        for node in range(len(self._nodes)):
+            self._out[node] = array("i", set(self._out[node]))
+            self._in[node] = array("i", set(self._in[node]))
+        self.edge_count = sum(len(edges) for edges in self._out)
+        print("  Found {} nodes and {} edges.".format(self.node_count, self.edge_count))
+
+    # Nodes as (type, name id) columns and the adjacency as flattened arrays, for snapshots.
+    def pack(self):
+        type_codes = dict((type_label, type_code) for type_code, type_label in enumerate(NODE_TYPES))
+        return {"types": array("b", (type_codes[type_label] for type_label, _ in self._nodes)),
+                "names": array("i", (bh_names.intern(name) for _, name in self._nodes)),
+                "out": pack_arrays(self._out), "in": pack_arrays(self._in), "edge_count": self.edge_count}
+
+    @classmethod
+    def unpack(cls, state):
+        graph = cls.__new__(cls)
+        graph._ids = dict((type_label, {}) for type_label in NODE_TYPES)
+        names = bh_names.names
+        graph._nodes = [(NODE_TYPES[type_code], names[name_id])
+                        for type_code, name_id in zip(state["types"], state["names"])]
+        for node, (type_label, name) in enumerate(graph._nodes):
+            graph._ids[type_label][name] = node
+        graph._out = unpack_arrays(*state["out"])
+        graph._in = unpack_arrays(*state["in"])
+        graph.edge_count = state["edge_count"]
+        return graph
+
+    def node_id(self, type_label, name):
+        ids = self._ids[type_label]
+        node = ids.get(name)
+        if node is None:
+            node = len(self._nodes)
+            ids[name] = node
+            self._nodes.append((type_label, name))
+            self._out.append([])
+            self._in.append([])
+        return node
+
+    @property
+    def node_count(self):
+        return len(self._nodes)
+
+    def find(self, type_label, name):
+        return self._ids[type_label].get(name)
+
+    def node(self, node):
+        return self._nodes[node]
+
+    def _add_edge(self, source, target, kind):
+        self._out[source].append((target << 2) | kind)
+        self._in[target].append((source << 2) | kind)
+
+    # Patches the HasSession edges after a session reload; added and removed are sets of (user, computer) names.
+    # Removals are grouped by node and each touched node's edges rewritten once, so busy computers with thousands of
+    # sessions aren't scanned once per session that went away.
+    def update_sessions(self, added, removed):
+        removed_out = collections.defaultdict(set)
+        removed_in = collections.defaultdict(set)
+        for user, computer in removed:
+            computer_id = self.find("computers", computer)
+            user_id = self.find("users", user)
+            removed_out[computer_id].add((user_id << 2) | HAS_SESSION)
+            removed_in[user_id].add((computer_id << 2) | HAS_SESSION)
+        for edges, removals in [(self._out, removed_out), (self._in, removed_in)]:
+            for node, gone in removals.items():
+                edges[node] = array("i", [edge for edge in edges[node] if edge not in gone])
+        for user, computer in added:
+            self._add_edge(self.node_id("computers", computer), self.node_id("users", user), HAS_SESSION)
+        self.edge_count += len(added) - len(removed)
+
+    def _count(self, **counts):
+        if self.counters is not None:
+            for key, value in counts.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def edge_label(self, source, target):
+        for edge in self._out[source]:
+            if edge >> 2 == target:
+                return EDGE_LABELS[edge & 3]
+        return None
+
+    # With max_length, paths of more than that many edges are not looked for.
+    def shortest_path(self, source, target, banned_nodes=frozenset(), banned_edges=frozenset(), max_length=None):
+        if source == target:
+            return [source]
+        expanded = 0
+        scanned = 0
+        forward = {source: (None, 0)}
+        backward = {target: (None, 0)}
+        forward_frontier = [source]
+        backward_frontier = [target]
+        levels = 0
+
+        # Always expand the smaller frontier one full level at a time; the best meeting point within that level
+        # is guaranteed to lie on a shortest path.
+        while forward_frontier and backward_frontier:
+            if max_length is not None and levels >= max_length:
+                break
+            levels += 1
+            best = None
+            next_frontier = []
+            if len(forward_frontier) <= len(backward_frontier):
+                expanded += len(forward_frontier)
+                for node in forward_frontier:
+                    depth = forward[node][1] + 1
+                    scanned += len(self._out[node])
+                    for edge in self._out[node]:
+                        neighbor = edge >> 2
+                        if neighbor in forward or neighbor in banned_nodes or (node, neighbor) in banned_edges:
+                            continue
+                        forward[neighbor] = (node, depth)
+                        next_frontier.append(neighbor)
+                        if neighbor in backward:
+                            length = depth + backward[neighbor][1]
+                            if best is None or length < best[0]:
+                                best = (length, neighbor)
+                forward_frontier = next_frontier
+            else:
+                expanded += len(backward_frontier)
+                for node in backward_frontier:
+                    depth = backward[node][1] + 1
+                    scanned += len(self._in[node])
+                    for edge in self._in[node]:
+                        neighbor = edge >> 2
+                        if neighbor in backward or neighbor in banned_nodes or (neighbor, node) in banned_edges:
+                            continue
+                        backward[neighbor] = (node, depth)
+                        next_frontier.append(neighbor)
+                        if neighbor in forward:
+                            length = depth + forward[neighbor][1]
+                            if best is None or length < best[0]:
+                                best = (length, neighbor)
+                backward_frontier = next_frontier
+
+            if best is not None:
+                path = []
+                node = best[1]
+                while node is not None:
+                    path.append(node)
+                    node = forward[node][0]
+                path.reverse()
+                node = backward[best[1]][0]
+                while node is not None:
+                    path.append(node)
+                    node = backward[node][0]
+                self._count(searches=1, nodes_expanded=expanded, edges_scanned=scanned)
+                return path
+        self._count(searches=1, nodes_expanded=expanded, edges_scanned=scanned)
+        return None
+
+    # Yen's algorithm over the unweighted graph, so paths come out shortest first and are always loop free.  Each
+    # path is yielded as soon as it is found.  max=0 means no limit, max_length limits the number of edges and the
+    # search gives up at deadline (a time.time() value), checked between searches.
+    def k_shortest_paths(self, source, target, max=10, max_length=None, deadline=None):
+        first = self.shortest_path(source, target, max_length=max_length)
+        if first is None:
+            return
+        found = [first]
+        found_set = {tuple(first)}
+        candidates = []
+        counter = 0
+        yield first
+        while max == 0 or len(found) < max:
+            previous = found[-1]
+            for i in range(len(previous) - 1):
+                if deadline is not None and time.time() >= deadline:
+                    return
+                root = previous[:i + 1]
+                banned_edges = set()
+                for path in found:
+                    if len(path) > i + 1 and path[:i + 1] == root:
+                        banned_edges.add((path[i], path[i + 1]))
+                # The root already has i edges.
+                spur = self.shortest_path(previous[i], target, frozenset(root[:-1]), banned_edges,
+                                          None if max_length is None else max_length - i)
+                self._count(spur_searches=1)
+                if spur is not None:
+                    candidate = tuple(root[:-1] + spur)
+                    if candidate not in found_set:
+                        self._count(candidates=1)
+                        found_set.add(candidate)
+                        counter += 1
+                        heapq.heappush(candidates, (len(candidate), counter, candidate))
+            if len(candidates) == 0:
+                break
+            found.append(list(heapq.heappop(candidates)[2]))
+            yield found[-1]
+
+    # Paths as lists of (type label, name, edge label into it) steps, shortest first, as they are found.  max_depth
+    # limits the number of hops and timeout the seconds spent looking.
+    def trace(self, source_type, source_name, target_type, target_name, max=10, max_depth=None, timeout=None):
+        source = self.find(source_type, source_name)
+        target = self.find(target_type, target_name)
+        if source is None or target is None:
+            return
+        self.counters = {"command": "trace", "paths_found": 0}
+        start = time.time()
+        try:
+            for path in self.k_shortest_paths(source, target, max, max_depth,
+                                              None if timeout is None else start + timeout):
+                steps = []
+                previous = None
+                for node in path:
+                    type_label, name = self._nodes[node]
+                    steps.append((type_label, name, None if previous is None else self.edge_label(previous, node)))
+                    previous = node
+                self._count(paths_found=1)
+                yield steps
+        finally:
+            self._count(seconds=time.time() - start)
+
+    # One breadth first search backwards from the target, so every node that can reach it is found with its distance
+    # and the edge it takes towards the target (packed like the adjacency entries) in O(nodes + edges).
+    def reach_from(self, target):
+        distance = {target: 0}
+        next_hop = {target: None}
+        frontier = [target]
+        order = []
+        scanned = 0
+        while frontier:
+            next_frontier = []
+            for node in frontier:
+                depth = distance[node] + 1
+                scanned += len(self._in[node])
+                for edge in self._in[node]:
+                    neighbor = edge >> 2
+                    if neighbor not in distance:
+                        distance[neighbor] = depth
+                        next_hop[neighbor] = (node << 2) | (edge & 3)
+                        next_frontier.append(neighbor)
+                        order.append(neighbor)
+            frontier = next_frontier
+        self._count(nodes_expanded=len(order) + 1, edges_scanned=scanned)
+        return order, distance, next_hop
+
+    # Every source (of source_type, or any type) with a path to the target, nearest first, with its hop count and
+    # one shortest path in the same form trace() uses.
+    def reach(self, target_type, target_name, source_type=None):
+        target = self.find(target_type, target_name)
+        if target is None:
+            return []
+        self.counters = {"command": "reach"}
+        start = time.time()
+        order, distance, next_hop = self.reach_from(target)
+        results = []
+        for source in order:
+            type_label, name = self._nodes[source]
+            if source_type is not None and type_label != source_type:
+                continue
+            steps = [(type_label, name, None)]
+            hop = next_hop[source]
+            while hop is not None:
+                type_label, name = self._nodes[hop >> 2]
+                steps.append((type_label, name, EDGE_LABELS[hop & 3]))
+                hop = next_hop[hop >> 2]
+            results.append((steps[0][1], distance[source], steps))
+        results.sort(key=lambda result: (result[1], result[0]))
+        self._count(paths_found=len(results), seconds=time.time() - start)
+        return results
+
+
+REGEX_SPECIAL = set("\\^$*+?{}[]|()")
+RESULT_CACHE_SIZE = 256
+
+
+@functools.lru_cache(maxsize=RESULT_CACHE_SIZE)
+def compile_pattern(regex):
+    return re.compile(regex, flags=re.IGNORECASE)
+
+
+# Case-folded name lookups for list/select_one.  Plain text is answered from sorted name lists (exact and prefix
+# matches) and a trigram index (substrings); anything that really is a regex is scanned, with an LRU of results.
+class NameIndex:
+
+    # state is what pack() returned, from a snapshot: the sort orders and trigram postings are taken from it instead of
+    # being worked out again.
+    def __init__(self, names, state=None):
+        self.names = list(names)
+        self._folded = [name.casefold() for name in self.names]
+        # The account part of USER@DOMAIN and the host part of HOST.DOMAIN names also count as exact matches.
+        short_names = [folded.split("@")[0] if "@" in folded else folded.split(".")[0] for folded in self._folded]
+        if state is None:
+            self._sorted = array("i", sorted(range(len(self.names)), key=self._folded.__getitem__))
+            self._sorted_short = array("i", sorted(range(len(self.names)), key=short_names.__getitem__))
+            self._trigrams = {}
+            for position, folded in enumerate(self._folded):
+                for trigram in set(folded[i:i + 3] for i in range(len(folded) - 2)):
+                    if trigram not in self._trigrams:
+                        self._trigrams[trigram] = array("i")
+                    self._trigrams[trigram].append(position)
+        else:
+            self._sorted = state["sorted"]
+            self._sorted_short = state["sorted_short"]
+            self._trigrams = dict(zip(state["trigrams"], unpack_arrays(*state["postings"])))
+        self._sorted_folded = [self._folded[position] for position in self._sorted]
+        self._sorted_short_names = [short_names[position] for position in self._sorted_short]
+        self._results = collections.OrderedDict()
+
+    def pack(self):
+        return {"sorted": self._sorted, "sorted_short": self._sorted_short, "trigrams": list(self._trigrams.keys()),
+                "postings": pack_arrays(self._trigrams.values())}
+
+    def cache_size(self):
+        return len(self._results)
+
+    # Positions (in load order) of every name that might contain the text.
+    def _candidates(self, text):
+        if len(text) < 3:
+            return range(len(self.names))
+        smallest = None
+        for i in range(len(text) - 2):
+            postings = self._trigrams.get(text[i:i + 3])
+            if postings is None:
+                return ()
+            if smallest is None or len(postings) < len(smallest):
+                smallest = postings
+        return smallest
+
+    def _collect(self, sorted_names, positions, folded, prefix, results, seen, max):
+        i = bisect.bisect_left(sorted_names, folded)
+        while len(results) < max and i < len(positions):
+            if sorted_names[i] != folded and not (prefix and sorted_names[i].startswith(folded)):
+                break
+            if positions[i] not in seen:
+                seen.add(positions[i])
+                results.append(self.names[positions[i]])
+            i += 1
+
+    # Names equal to the text, or whose account/host part is (a trailing '@' or '.', as in "bob@", is ignored).
+    def exact(self, text, max=25):
+        results = []
+        seen = set([])
+        folded = text.casefold()
+        self._collect(self._sorted_folded, self._sorted, folded, False, results, seen, max)
+        self._collect(self._sorted_short_names, self._sorted_short, folded.rstrip("@."), False, results, seen, max)
+        return results
+
+    def search(self, regex, max=20):
+        if REGEX_SPECIAL.isdisjoint(regex):
+            return self._search_text(regex, max)
+
+        # The server runs searches from several threads, so another search may drop this key at any point.
+        key = (regex, max)
+        results = self._results.get(key)
+        if results is not None:
+            try:
+                self._results.move_to_end(key)
+            except KeyError:
+                pass
+        else:
+            pattern = compile_pattern(regex)
+            results = []
+            for name in self.names:
+                if pattern.search(name) is not None:
+                    results.append(name)
+                    if len(results) == max:
+                        break
+            self._results[key] = results
+            while len(self._results) > RESULT_CACHE_SIZE:
+                try:
+                    self._results.popitem(last=False)
+                except KeyError:
+                    break
+        return list(results)
+
+    # Exact matches first, then prefixes, then any other substring.  A '.' is still a regex wildcard, so dotted names
+    # (i.e. most computers) use their longest dot-free part to find candidates and the regex to confirm them.
+    def _search_text(self, text, max):
+        folded = text.casefold()
+        pattern = None
+        literal = folded
+        if "." in folded:
+            pattern = compile_pattern(text)
+            literal = sorted(folded.split("."), key=len)[-1]
+
+        results = []
+        seen = set([])
+        self._collect(self._sorted_folded, self._sorted, folded, False, results, seen, max)
+        self._collect(self._sorted_short_names, self._sorted_short, folded, False, results, seen, max)
+        self._collect(self._sorted_folded, self._sorted, folded, True, results, seen, max)
+        if len(results) >= max:
+            return results
+
+        for position in self._candidates(literal):
+            if len(results) >= max:
+                break
+            if position not in seen:
+                if (folded in self._folded[position] if pattern is None
+                        else pattern.search(self.names[position]) is not None):
+                    seen.add(position)
+                    results.append(self.names[position])
+        return results
+
+
+class AmbiguousMatch(Exception):
+
+    def __init__(self, regex, candidates):
+        super().__init__("Multiple matches for '{}': {}".format(regex, ", ".join(candidates)))
+        self.candidates = candidates
+
+
+# With lazy, records only remember where their object is in the file.  Zip members can't be seeked into without
+# decompressing them from the start, so their records keep their details as usual.
+def read_records(record_class, type_label, json_file, lazy=False):
+    records = []
+    spans = lazy and split_source(json_file)[1] is None
+    for item in iter_json_array(json_file, type_label, spans):
+        obj, source = (item[0], (json_file,) + item[1:]) if spans else (item, None)
+        name = obj.get("Name")
+        if name is not None:
+            records.append(record_class(bh_names.intern(name), obj, source))
+    return records
+
+
+def read_object(json_file, start, end):
+    with open(json_file, "rb") as f:
+        f.seek(start)
+        return json.loads(f.read(end - start).decode("utf-8"))
 
 
 class BloodhoundObject:
+    record_class = Record
 
-    def __init__(self, type_label, json_file):
+    def __init__(self, type_label, json_file=None, records=None):
         self.type_label = type_label
-        print("Loading {}...".format(self.type_label))
-        with open(json_file, 'r') as f:
-            loaded_json = json.load(f)
-            self.data_dict = {}
-            for obj in loaded_json.get(type_label, []):
-                name = obj.get("Name")
-                if name is not None:
-                    self.data_dict[name] = obj
-            print("  Found {} {} entries.".format(len(self.data_dict), type_label))
+        if records is None:
+            print("Loading {}...".format(self.type_label))
+            records = read_records(self.record_class, type_label, json_file)
+        else:
+            print("Indexing {}...".format(self.type_label))
+        self.data_dict = {}
+        for record in records:
+            self.data_dict[record.name] = record
+        self._name_index = None
+        print("  Found {} {} entries.".format(len(self.data_dict), type_label))
 
-    def print_details(self, name):
+    # The records and name index, for snapshots.  Everything else is indexed again from the records by unpack.
+    def pack(self):
+        return {"records": self.record_class.pack(list(self.data_dict.values())),
+                "name_index": None if self._name_index is None else self._name_index.pack()}
+
+    @classmethod
+    def unpack(cls, state):
+        objects = cls(records=cls.record_class.unpack(state["records"]))
+        if state["name_index"] is not None:
+            objects._name_index = NameIndex(objects.data_dict.keys(), state["name_index"])
+        return objects
+
+    # Entries in each cache that commands have filled so far, for the stats command.
+    def cache_sizes(self):
+        return {"name_searches": 0 if self._name_index is None else self._name_index.cache_size()}
+
+    def describe(self, name):
         if self.data_dict.get(name) is None:
+            return None
+        return {"name": name, "details": self.data_dict.get(name).details()}
+
+    def print_details(self, name):
+        description = self.describe(name)
+        if description is None:
             print("Couldn't find a matching {}".format(self.type_label[:-1]))
         else:
-            print("Details for {}:".format(name))
-            print("=" * (13 + len(name)))
-            print(json.dumps(self.data_dict.get(name), indent=2, sort_keys=True))
+            self.print_description(description)
+
+    def print_description(self, description):
+        print("Details for {}:".format(description["name"]))
+        print("=" * (13 + len(description["name"])))
+        print(json.dumps(description["details"], indent=2, sort_keys=True))
 
     def print_list(self, regex="", max=20):
         obj_list = self.list(regex, max)
         for obj in obj_list:
             print(obj)
         if len(obj_list) == max:
-            print("* There may be more, I stopped looking after 20.  Use max=<n> to specify a higher limit.")
+            print("* There may be more, I stopped looking after {}.  Use max=<n> to specify a higher limit.".format(max))
         print("Found {} matching {}".format(len(obj_list), self.type_label))
 
+    def name_index(self):
+        if self._name_index is None:
+            self._name_index = NameIndex(self.data_dict.keys())
+        return self._name_index
+
     def list(self, regex="", max=20):
-        pattern = re.compile(regex, flags=re.IGNORECASE)
-        results = []
-        for name in self.data_dict.keys():
-            if pattern.search(name) is not None:
-                results.append(name)
-                if len(results) == max:
-                    break
-        return results
+        return self.name_index().search(regex, max)
 
-    def select_one(self, regex=".*", max=25):
+    # With pick=None the user is asked to choose between several matches.  Otherwise nobody is there to ask: a single
+    # exact match wins, then "first" takes the best ranked match and "exact" gives up with AmbiguousMatch.
+    def select_one(self, regex=".*", max=25, pick=None):
         results = self.list(regex, max)
         if len(results) == 0:
             return None
         elif len(results) == 1:
             return results[0]
+        elif pick is not None:
+            exact = self.name_index().exact(regex, max)
+            if len(exact) == 1:
+                return exact[0]
+            elif pick == "first":
+                return results[0]
+            raise AmbiguousMatch(regex, results)
         else:
             print("Multiple matches for '{}'.  Please select one:".format(regex))
             while True:
@@ -101,168 +1141,518 @@ class BloodhoundObject:
                     if int(selected) in range(0, len(results)):
                         return results[int(selected)]
 
-    # The history is a dictionary used to dedupe paths so we don't go around in circles.
-    def trace(self, source_name, target_type, target_name, trace_history: TraceHistory):
-        return []
+    def trace(self, source_name, target_type, target_name, max=10, max_depth=None, timeout=None):
+        return bh_graph["graph"].trace(self.type_label, source_name, target_type, target_name, max, max_depth, timeout)
+
+    def reach(self, target_name, source_type=None):
+        return bh_graph["graph"].reach(self.type_label, target_name, source_type)
 
 
 class Computers(BloodhoundObject):
-    def __init__(self, json_file):
-        super().__init__("computers", json_file)
-        self.localadmin_users = {}
-        for computer_name in self.data_dict.keys():
-            for user in self.data_dict.get(computer_name).get("LocalAdmins", []):
-                if user.get("Type") == "User":
-                    user_name = user.get("Name")
-                    if user_name not in self.localadmin_users:
-                        self.localadmin_users[user_name] = []
-                    self.localadmin_users[user_name].append(computer_name)
+    record_class = ComputerRecord
+
+    def __init__(self, json_file=None, records=None):
+        super().__init__("computers", json_file, records)
+        # Inverted ACLs: principal name -> set of computer names, for users, groups and computers alike.
+        self.admin_index = {}
+        self.rdp_index = {}
+        self.principal_types = {}
+        self._effective_counts = None
+        self._rows = {}
+        for computer_name, computer in self.data_dict.items():
+            self._index_aces(self.admin_index, computer_name, computer.local_admins)
+            self._index_aces(self.rdp_index, computer_name, computer.remote_desktop_users)
+
+    def _index_aces(self, index, computer_name, aces):
+        for ace in aces:
+            name = bh_names.names[ace >> 2]
+            self.principal_types[name] = PRINCIPAL_NAMES[ace & 3]
+            if name not in index:
+                index[name] = set([])
+            index[name].add(computer_name)
 
     def list_access(self, user, groups=None):
         if groups is None:
             groups = []
-        local_admin_access = []
-        remote_desktop_access = []
-        for computer_name in self.data_dict.keys():
-            for local_admin in self.data_dict.get(computer_name).get("LocalAdmins", []):
-                if local_admin.get("Name", "") == user and local_admin.get("Type",
-                                                                           "") == "User" and computer_name not in local_admin_access:
-                    local_admin_access.append(computer_name)
-                elif local_admin.get("Name", "") in groups and local_admin.get("Type",
-                                                                               "") == "Group" and computer_name not in local_admin_access:
-                    local_admin_access.append(computer_name)
-
-            for remote_desktop in self.data_dict.get(computer_name).get("RemoteDesktopUsers", []):
-                if remote_desktop.get("Name", "") == user and remote_desktop.get("Type",
-                                                                                 "") == "User" and computer_name not in remote_desktop_access:
-                    remote_desktop_access.append(computer_name)
-                elif remote_desktop.get("Name", "") in groups and remote_desktop.get("Type",
-                                                                                     "") == "Group" and computer_name not in remote_desktop_access:
-                    remote_desktop_access.append(computer_name)
-        return local_admin_access, remote_desktop_access
-
-    def trace(self, source_name, target_type, target_name, trace_history):
-        paths = []
-        trace_history.add_computer(source_name)
-
-        if source_name == target_name and target_type == "computers":
-            return [deque([{"computers": target_name}])]
-        else:
-            user_sessions = bh_sessions["sessions"].for_computer(source_name)
-            trace_history.dedupe_users(user_sessions)
+        local_admin_access = set(self.admin_index.get(user, []))
+        remote_desktop_access = set(self.rdp_index.get(user, []))
+        for group in groups:
+            local_admin_access.update(self.admin_index.get(group, []))
+            remote_desktop_access.update(self.rdp_index.get(group, []))
+        return sorted(local_admin_access), sorted(remote_desktop_access)
 
-            for user in user_sessions:
-                trace_history.add_user(user)
-                user_paths = bh_data["users"].trace(user, target_type, target_name, trace_history.copy())
-                for up in user_paths:
-                    up.appendleft({"computers": source_name})
-                    paths.append(up)
-            return paths
+    # Access granted directly or through any (nested) group.  Nothing is kept per principal: the group closures are
+    # already cached per group component, so a long running server doesn't grow with every name it is asked about.
+    def effective_access(self, principal, principal_type="user"):
+        return self.list_access(principal, bh_data["groups"].for_member(principal, principal_type))
 
-    def print_details(self, name):
-        super().print_details(name)
+    def describe(self, name):
+        description = super().describe(name)
+        if description is not None:
+            description["sessions"] = sorted(bh_sessions["sessions"].for_computer(name))
+        return description
+
+    def print_description(self, description):
+        super().print_description(description)
         print("Active Sessions:")
-        for computer in bh_sessions["sessions"].for_computer(name):
-            print("  {}".format(computer))
+        for user in description["sessions"]:
+            print("  {}".format(user))
 
-    def top_localadmins(self, max=10):
-        top_users = []
-        for k in sorted(self.localadmin_users, key=lambda k: len(self.localadmin_users[k]), reverse=True):
-            top_users.append(k)
-            if len(top_users) >= max:
-                break
-        return top_users
+    # computer -> direct local admins (or principal -> computers it is a direct local admin of with reverse) as
+    # SparseRows.
+    def admin_rows(self, reverse=False):
+        if reverse not in self._rows:
+            if reverse:
+                self._rows[reverse] = self.admin_rows().transpose()
+            else:
+                computers = array("i")
+                admins = array("i")
+                for computer_name, computer in self.data_dict.items():
+                    computers.extend([bh_names.intern(computer_name)] * len(computer.local_admins))
+                    admins.extend(ace >> 2 for ace in computer.local_admins)
+                self._rows[reverse] = SparseRows(computers, admins)
+        return self._rows[reverse]
+
+    def cache_sizes(self):
+        sizes = super().cache_sizes()
+        sizes["sparse_rows"] = len(self._rows)
+        return sizes
+
+    # Access through nested groups, counted with set unions: the computers of each group component that is
+    # granted access itself (the index's own sets, unless several groups share the component), and for every component
+    # the set of those granting components it or any component it is nested in belongs to.  Equal sets are shared, so
+    # a whole subtree under one admin group costs one frozenset.  Parent components have lower ids, so they are always
+    # done first.
+    def _component_access(self, index):
+        groups = bh_data["groups"]
+        granted = {}
+        granting = []
+        shared = {frozenset(): frozenset()}
+        for component, (group_names, parents) in enumerate(groups.components()):
+            own = [index[group_name] for group_name in group_names if group_name in index]
+            if own:
+                granted[component] = own[0] if len(own) == 1 else frozenset().union(*own)
+            elif len(parents) == 1:
+                granting.append(granting[next(iter(parents))])
+                continue
+            grants = frozenset().union([component] if own else [], *(granting[parent] for parent in parents))
+            granting.append(shared.setdefault(grants, grants))
+        return granted, granting
+
+    # The granting components behind a principal's groups.
+    @staticmethod
+    def _granting(components, access):
+        granting = access[1]
+        if len(components) == 1:
+            return granting[next(iter(components))]
+        return frozenset().union(*(granting[component] for component in components))
+
+    # Computers granted directly or by the granting components.  A set from the index comes back as it is when there
+    # is nothing to add to it, so the result must not be changed.
+    @staticmethod
+    def _granted(granting, access, direct=()):
+        sets = [access[0][component] for component in granting]
+        if direct:
+            sets.append(direct)
+        if len(sets) == 1:
+            return sets[0]
+        return set().union(*sets)
+
+    # Principals in the same groups share their count, which is all that is kept, by set of granting components.
+    def _member_count(self, direct, components, access, counts):
+        if len(components) == 0:
+            return len(direct)
+        granting = self._granting(components, access)
+        if direct:
+            return len(self._granted(granting, access, direct))
+        count = counts.get(granting)
+        if count is None:
+            count = counts[granting] = len(self._granted(granting, access))
+        return count
+
+    # The local admin and remote desktop access of the group components.
+    def _access(self):
+        return self._component_access(self.admin_index), self._component_access(self.rdp_index)
 
-    def localadmin_for_user(self, user):
-        return self.localadmin_users.get(user, [])
+    # principal type -> name -> (local admin count, remote desktop count), through nested groups, for every user,
+    # computer and group with any access.  Built in one pass the first time it is needed.
+    def effective_counts(self):
+        if self._effective_counts is None:
+            groups = bh_data["groups"]
+            admin, rdp = self._access()
+            admin_counts = {}
+            rdp_counts = {}
+
+            counts = {"user": {}, "computer": {}, "group": {}}
+            for component, (group_names, _) in enumerate(groups.components()):
+                access = (self._member_count((), [component], admin, admin_counts),
+                          self._member_count((), [component], rdp, rdp_counts))
+                if access != (0, 0):
+                    for group_name in group_names:
+                        counts["group"][group_name] = access
+            for principal, principal_type in self.principal_types.items():
+                if principal_type == "Group" and groups.component_of(principal) is None:
+                    counts["group"][principal] = (len(self.admin_index.get(principal, ())),
+                                                  len(self.rdp_index.get(principal, ())))
+            for principal_type in ["user", "computer"]:
+                member_of = groups.parents.get(principal_type, {})
+                principals = dict.fromkeys(member_of.keys())
+                for principal in list(self.admin_index.keys()) + list(self.rdp_index.keys()):
+                    if self.principal_types.get(principal, "").lower() == principal_type:
+                        principals[principal] = None
+                for principal in principals:
+                    components = set(groups.component_of(group_name) for group_name in member_of.get(principal, ()))
+                    access = (self._member_count(self.admin_index.get(principal, ()), components, admin, admin_counts),
+                              self._member_count(self.rdp_index.get(principal, ()), components, rdp, rdp_counts))
+                    if access != (0, 0):
+                        counts[principal_type][principal] = access
+            self._effective_counts = counts
+        return self._effective_counts
+
+    # The effective access counts are kept in snapshots as (name id, local admin, remote desktop) columns per type.
+    def pack(self):
+        state = super().pack()
+        if self._effective_counts is not None:
+            state["effective_counts"] = dict(
+                (principal_type, {"names": array("i", (bh_names.intern(name) for name in counts.keys())),
+                                  "admin": array("i", (access[0] for access in counts.values())),
+                                  "rdp": array("i", (access[1] for access in counts.values()))})
+                for principal_type, counts in self._effective_counts.items())
+        return state
+
+    @classmethod
+    def unpack(cls, state):
+        computers = super().unpack(state)
+        if "effective_counts" in state:
+            names = bh_names.names
+            computers._effective_counts = dict(
+                (principal_type, dict((names[name_id], (admin, rdp)) for name_id, admin, rdp in zip(
+                    columns["names"], columns["admin"], columns["rdp"])))
+                for principal_type, columns in state["effective_counts"].items())
+        return computers
+
+    # (name, local admin computers, remote desktop computers) for each of the principals, through nested groups and
+    # sorted by computer name.  The granting components are worked out once up front, so the cost after that is one
+    # set union per principal and the size of the results; nothing is kept between principals.
+    def iter_effective_access(self, principals, principal_type="user"):
+        groups = bh_data["groups"]
+        member_of = groups.parents.get(principal_type, {})
+        admin, rdp = self._access()
+        for principal in principals:
+            components = set(groups.component_of(group_name) for group_name in member_of.get(principal, ()))
+            yield (principal,
+                   sorted(self._granted(self._granting(components, admin), admin, self.admin_index.get(principal, ()))),
+                   sorted(self._granted(self._granting(components, rdp), rdp, self.rdp_index.get(principal, ()))))
+
+    # Principals of the given type with effective access to the most computers, as (name, count) pairs.
+    def top_effective(self, max=10, principal_type="user", remote_desktop=False):
+        counts = self.effective_counts()[principal_type]
+        column = 1 if remote_desktop else 0
+        top = heapq.nlargest(max, counts.items(), key=lambda item: item[1][column])
+        return [(name, access[column]) for name, access in top if access[column] > 0]
 
 
 class Domains(BloodhoundObject):
-    def __init__(self, json_file):
-        super().__init__("domains", json_file)
+    def __init__(self, json_file=None, records=None):
+        super().__init__("domains", json_file, records)
 
-    def print_details(self, name):
-        super().print_details(name)
+    def describe(self, name):
+        description = super().describe(name)
+        if description is not None:
+            description["trusts"] = []
+            for trust in description["details"].get("Trusts") or []:
+                direction = trust.get("TrustDirection", -1)
+                if direction == 1:
+                    description["trusts"].append("{}({}) trusts {}".format(trust.get("TargetName", "target"),
+                                                                          trust.get("TrustType", "unknown"), name))
+                elif direction == 2:
+                    description["trusts"].append("{} trusts {}({})".format(name, trust.get("TargetName"),
+                                                                          trust.get("TrustType", "unknown")))
+                elif direction == 3:
+                    description["trusts"].append("{} and {}({}) trust each other.".format(
+                        name, trust.get("TargetName"), trust.get("TrustType", "unknown")))
+                elif direction == 0:
+                    description["trusts"].append("{} has an inactive trust with {}({})".format(
+                        name, trust.get("TargetName", "target"), trust.get("TrustType", "unknown")))
+        return description
+
+    def print_description(self, description):
+        super().print_description(description)
         print("English Translation of Trusts:")
-        for trust in self.data_dict.get(name, {}).get("Trusts", []):
-            direction = trust.get("TrustDirection", -1)
-            if direction == 1:
-                print("  {}({}) trusts {}".format(trust.get("TargetName", "target"), trust.get("TrustType", "unknown"),
-                                                  name))
-            elif direction == 2:
-                print("  {} trusts {}({})".format(name, trust.get("TargetName"), trust.get("TrustType", "unknown")))
-            elif direction == 3:
-                print("  {} and {}({}) trust each other.".format(name, trust.get("TargetName"),
-                                                                 trust.get("TrustType", "unknown")))
-            elif direction == 0:
-                print("  {} has an inactive trust with {}({})".format(name, trust.get("TargetName", "target"),
-                                                                      trust.get("TrustType", "unknown")))
+        for trust in description["trusts"]:
+            print("  {}".format(trust))
 
 
 class Groups(BloodhoundObject):
-    def __init__(self, json_file):
-        super().__init__("groups", json_file)
+    record_class = GroupRecord
+
+    def __init__(self, json_file=None, records=None):
+        super().__init__("groups", json_file, records)
+        # parents: member type -> member name -> set of groups it is a direct member of.
+        self.parents = {"user": {}, "group": {}, "computer": {}}
+        self.direct_users = {}
+        for group_name, group in self.data_dict.items():
+            for member in group.members:
+                member_name = bh_names.names[member >> 2]
+                member_type = PRINCIPAL_NAMES[member & 3].lower()
+                if member_type not in self.parents:
+                    self.parents[member_type] = {}
+                if member_name not in self.parents[member_type]:
+                    self.parents[member_type][member_name] = set([])
+                self.parents[member_type][member_name].add(group_name)
+                if member_type == "user":
+                    if group_name not in self.direct_users:
+                        self.direct_users[group_name] = set([])
+                    self.direct_users[group_name].add(member_name)
+        self._rows = {}
+        self._condense()
+
+    # Collapse circular nesting into strongly connected components (iterative Tarjan) so the nesting becomes a DAG.
+    # Tarjan emits a component only after everything reachable from it, so parent components get lower ids.
+    def _condense(self):
+        group_parents = self.parents["group"]
+        nodes = list(self.data_dict.keys()) + list(group_parents.keys())
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set([])
+        self._component = {}
+        self._component_groups = []
+        for root in nodes:
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(group_parents.get(root, ())))]
+            while work:
+                node, neighbors = work[-1]
+                descended = False
+                for neighbor in neighbors:
+                    if neighbor not in index:
+                        index[neighbor] = lowlink[neighbor] = len(index)
+                        stack.append(neighbor)
+                        on_stack.add(neighbor)
+                        work.append((neighbor, iter(group_parents.get(neighbor, ()))))
+                        descended = True
+                        break
+                    elif neighbor in on_stack:
+                        lowlink[node] = min(lowlink[node], index[neighbor])
+                if descended:
+                    continue
+                work.pop()
+                if work:
+                    lowlink[work[-1][0]] = min(lowlink[work[-1][0]], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = len(self._component_groups)
+                    members = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        self._component[member] = component
+                        members.append(member)
+                        if member == node:
+                            break
+                    self._component_groups.append(members)
+
+        self._component_parents = [set([]) for _ in self._component_groups]
+        self._component_children = [set([]) for _ in self._component_groups]
+        for group_name, parent_groups in group_parents.items():
+            component = self._component[group_name]
+            for parent in parent_groups:
+                if self._component[parent] != component:
+                    self._component_parents[component].add(self._component[parent])
+                    self._component_children[self._component[parent]].add(component)
+        self._ancestors = {}
+        self._descendant_users = {}
+
+    # Memoized closure over the condensed DAG.  Components are resolved in id order so every linked component is
+    # already cached by the time it is needed.
+    def _closure(self, component, links, cache, collect, reverse):
+        if component in cache:
+            return cache[component]
+        pending = set([])
+        stack = [component]
+        while stack:
+            current = stack.pop()
+            if current not in pending and current not in cache:
+                pending.add(current)
+                stack.extend(links[current])
+        for current in sorted(pending, reverse=reverse):
+            result = set(collect(current))
+            for linked in links[current]:
+                result.update(cache[linked])
+            cache[current] = frozenset(result)
+        return cache[component]
+
+    # The condensed nesting for other classes: the component of a group (None for a name that isn't a group), and
+    # (member groups, parent components) for every component in id order, so parents always come first.
+    def component_of(self, group_name):
+        return self._component.get(group_name)
+
+    def components(self):
+        return zip(self._component_groups, self._component_parents)
+
+    def _groups_in(self, component):
+        return self._component_groups[component]
+
+    def _users_in(self, component):
+        users = set([])
+        for group_name in self._component_groups[component]:
+            users.update(self.direct_users.get(group_name, ()))
+        return users
 
     def for_member(self, member_name, member_type="user"):
-        results = []
-        for group_name in self.data_dict.keys():
-            for member in self.data_dict.get(group_name).get("Members", []):
-                if member.get("MemberName", "") == member_name and member.get("MemberType",
-                                                                              "") == member_type and group_name not in results:
-                    results.append(group_name)
-                    super_groups = self.for_member(group_name, "group")
-                    for super_group in super_groups:
-                        if super_group not in results:
-                            results.append(super_group)
-                    break
-        return results
+        results = set([])
+        for group_name in self.parents.get(member_type, {}).get(member_name, ()):
+            results.update(self._closure(self._component[group_name], self._component_parents, self._ancestors,
+                                         self._groups_in, False))
+        return sorted(results)
 
     def users(self, group_name):
-        user_set = set([])
-        for member in self.data_dict.get(group_name).get("Members", []):
-            if member.get("MemberType", "") == "user":
-                user_set.add(member.get("MemberName", ""))
-            elif member.get("MemberType", "") == "group":
-                user_set.update(self.users(member.get("MemberName")))
-        return user_set
-
-    def trace(self, source_name, target_type, target_name, trace_history):
-        paths = []
-        trace_history.add_group(source_name)
-
-        if target_type == "groups" and target_name == source_name:
-            return [deque([{"groups": target_name}])]
-        else:
-            return paths
+        component = self._component.get(group_name)
+        if component is None:
+            return set([])
+        return set(self._closure(component, self._component_children, self._descendant_users, self._users_in, True))
+
+    # group -> direct members (or member -> groups it is directly in with reverse) as SparseRows.
+    def member_rows(self, reverse=False):
+        if reverse not in self._rows:
+            if reverse:
+                self._rows[reverse] = self.member_rows().transpose()
+            else:
+                groups = array("i")
+                members = array("i")
+                for group_name, group in self.data_dict.items():
+                    groups.extend([bh_names.intern(group_name)] * len(group.members))
+                    members.extend(member >> 2 for member in group.members)
+                self._rows[reverse] = SparseRows(groups, members)
+        return self._rows[reverse]
+
+    def cache_sizes(self):
+        sizes = super().cache_sizes()
+        sizes["group_ancestors"] = len(self._ancestors)
+        sizes["group_users"] = len(self._descendant_users)
+        sizes["sparse_rows"] = len(self._rows)
+        return sizes
 
     def high_value(self, max=15):
         results = []
-        for group_name in self.data_dict.keys():
-            if self.data_dict.get(group_name, "").get("Properties", {}).get("highvalue", False):
+        for group_name, group in self.data_dict.items():
+            if len(results) >= max:
+                break
+            if group.highvalue:
                 results.append(group_name)
-                if len(results) == 15:
-                    break
         return results
 
 
+def read_session_pairs(json_file, required=False):
+    users = array("i")
+    computers = array("i")
+    session_count = 0
+    for session in iter_json_array(json_file, "sessions", required=required):
+        session_count += 1
+        user = session.get("UserName")
+        computer = session.get("ComputerName")
+        if user is not None and computer is not None:
+            users.append(bh_names.intern(user))
+            computers.append(bh_names.intern(computer))
+    return users, computers, session_count
+
+
 class Sessions:
-    def __init__(self, json_file):
-        print("Loading sessions...")
-        with open(json_file, 'r') as f:
-            all_sessions = json.load(f).get("sessions", [])
-            self.data_dict = {"users": {}, "computers": {}}
-            for session in all_sessions:
-                user = session.get("UserName")
-                computer = session.get("ComputerName")
-                if user is not None and computer is not None:
-                    if user not in self.data_dict["users"]:
-                        self.data_dict["users"][user] = set([])
-                    if computer not in self.data_dict["computers"]:
-                        self.data_dict["computers"][computer] = set([])
-                    self.data_dict["users"][user].add(computer)
-                    self.data_dict["computers"][computer].add(user)
-
-        print("  Found {} session entries.".format(len(all_sessions)))
+    def __init__(self, json_file=None, pairs=None):
+        if pairs is None:
+            print("Loading sessions...")
+            pairs = read_session_pairs(json_file)
+        else:
+            print("Indexing sessions...")
+        users, computers, session_count = pairs
+        self.data_dict = {"users": {}, "computers": {}}
+        for user_id, computer_id in zip(users, computers):
+            user = bh_names.names[user_id]
+            computer = bh_names.names[computer_id]
+            if user not in self.data_dict["users"]:
+                self.data_dict["users"][user] = set([])
+            if computer not in self.data_dict["computers"]:
+                self.data_dict["computers"][computer] = set([])
+            self.data_dict["users"][user].add(computer)
+            self.data_dict["computers"][computer].add(user)
+        self._rows = {}
+
+        print("  Found {} session entries.".format(session_count))
+
+    def pairs(self):
+        return set((user, computer) for user, computers in self.data_dict["users"].items() for computer in computers)
+
+    # Replaces all sessions with the given (user id, computer id) pairs, touching only the sessions that changed.
+    # Returns the (user, computer) name pairs that were added and removed.
+    def replace(self, users, computers):
+        names = bh_names.names
+        current = self.pairs()
+        new = set((names[user], names[computer]) for user, computer in zip(users, computers))
+        added = new - current
+        removed = current - new
+        for user, computer in removed:
+            self.data_dict["users"][user].discard(computer)
+            if len(self.data_dict["users"][user]) == 0:
+                del self.data_dict["users"][user]
+            self.data_dict["computers"][computer].discard(user)
+            if len(self.data_dict["computers"][computer]) == 0:
+                del self.data_dict["computers"][computer]
+        for user, computer in added:
+            self.data_dict["users"].setdefault(user, set([])).add(computer)
+            self.data_dict["computers"].setdefault(computer, set([])).add(user)
+        self._rows = {}
+        return added, removed
+
+    # user -> computers (or computer -> users with reverse) as SparseRows, built the first time they are needed.
+    def session_rows(self, reverse=False):
+        if reverse not in self._rows:
+            if reverse:
+                self._rows[reverse] = self.session_rows().transpose()
+            else:
+                self._rows[reverse] = SparseRows(*self.pair_columns())
+        return self._rows[reverse]
+
+    def cache_sizes(self):
+        return {"sparse_rows": len(self._rows)}
+
+    # Every session as (user id, computer id) columns.
+    def pair_columns(self):
+        users = array("i")
+        computers = array("i")
+        for user, user_computers in self.data_dict["users"].items():
+            users.extend([bh_names.intern(user)] * len(user_computers))
+            computers.extend(bh_names.intern(computer) for computer in user_computers)
+        return users, computers
+
+    # The pairs come out user by user, so the order computers were first seen in is kept as well; ties in targets are
+    # broken by it.
+    def pack(self):
+        users, computers = self.pair_columns()
+        return {"users": users, "computers": computers,
+                "computer_order": array("i", (bh_names.intern(computer) for computer in self.data_dict["computers"]))}
+
+    @classmethod
+    def unpack(cls, state):
+        sessions = cls(pairs=(state["users"], state["computers"], len(state["users"])))
+        by_computer = sessions.data_dict["computers"]
+        sessions.data_dict["computers"] = dict((computer, by_computer[computer]) for computer in (
+            bh_names.names[computer_id] for computer_id in state["computer_order"]))
+        return sessions
+
+    # (user, sorted computers) for each of the users, and every computer any of them has a session on.
+    def for_users(self, users):
+        rows = self.session_rows()
+        names = bh_names.names
+        user_ids = [bh_names.intern(user) for user in users]
+        sessions = list(zip(users, rows.row_names(user_ids)))
+        return sessions, sorted(names[computer] for computer in rows.union(user_ids))
+
+    # How many computers have sessions from users of both lists, for every pair of lists of users.
+    def overlap(self, user_lists):
+        return self.session_rows().overlap([[bh_names.intern(user) for user in users] for users in user_lists])
 
     def for_user(self, user):
         return self.data_dict["users"].get(user, set([]))
@@ -271,79 +1661,459 @@ class Sessions:
         return self.data_dict["computers"].get(computer, set([]))
 
     def top_users(self, max=10):
-        top_users = []
-        for k in sorted(self.data_dict["users"], key=lambda k: len(self.data_dict["users"][k]), reverse=True):
-            top_users.append(k)
-            if len(top_users) >= max:
-                break
-        return top_users
+        users = self.data_dict["users"]
+        return heapq.nlargest(max, users, key=lambda k: len(users[k]))
 
     def top_computers(self, max=10):
-        top_computers = []
-        for k in sorted(self.data_dict["computers"], key=lambda k: len(self.data_dict["computers"][k]), reverse=True):
-            top_computers.append(k)
-            if len(top_computers) >= max:
-                break
-        return top_computers
+        computers = self.data_dict["computers"]
+        return heapq.nlargest(max, computers, key=lambda k: len(computers[k]))
 
 
 class Users(BloodhoundObject):
-    def __init__(self, json_file):
-        super().__init__("users", json_file)
+    def __init__(self, json_file=None, records=None):
+        super().__init__("users", json_file, records)
 
-    def print_details(self, name):
-        super().print_details(name)
-        group_list = bh_data.get("groups").for_member(name)
-        if len(group_list) > 0:
+    def describe(self, name):
+        description = super().describe(name)
+        if description is not None:
+            localadmin, remotedesktop = bh_data.get("computers").effective_access(name)
+            description["groups"] = bh_data.get("groups").for_member(name)
+            description["local_admin"] = list(localadmin)
+            description["remote_desktop"] = list(remotedesktop)
+            description["sessions"] = sorted(bh_sessions["sessions"].for_user(name))
+        return description
+
+    # What describe lists for a user (nested groups, effective local admin and remote desktop access, sessions), for
+    # every user in name order.  Yielded one user at a time, so an export of any size runs in little memory.
+    def iter_access(self):
+        groups = bh_data["groups"]
+        sessions = bh_sessions["sessions"]
+        for name, local_admin, remote_desktop in bh_data["computers"].iter_effective_access(sorted(self.data_dict)):
+            yield {"name": name, "groups": groups.for_member(name), "local_admin": local_admin,
+                   "remote_desktop": remote_desktop, "sessions": sorted(sessions.for_user(name))}
+
+    def print_description(self, description):
+        super().print_description(description)
+        if len(description["groups"]) > 0:
             print("Groups:")
-            for group in group_list:
+            for group in description["groups"]:
                 print("  {}".format(group))
 
-        localadmin, remotedesktop = bh_data.get("computers").list_access(name, group_list)
-
-        if len(localadmin) > 0:
+        if len(description["local_admin"]) > 0:
             print("Local Admin Access:")
-            for computer in localadmin:
+            for computer in description["local_admin"]:
                 print("  {}".format(computer))
 
-        if len(remotedesktop) > 0:
+        if len(description["remote_desktop"]) > 0:
             print("Remote Desktop Access:")
-            for computer in remotedesktop:
+            for computer in description["remote_desktop"]:
                 print("  {}".format(computer))
 
         print("Active Sessions:")
-        for computer in bh_sessions["sessions"].for_user(name):
+        for computer in description["sessions"]:
             print("  {}".format(computer))
 
-    def trace(self, source_name, target_type, target_name, trace_history):
-        paths = []
 
-        trace_history.add_user(source_name)
+COLLECTION_CLASSES = [("computers", Computers), ("domains", Domains), ("groups", Groups), ("users", Users)]
+COLLECTION_FILES = ["computers.json", "domains.json", "groups.json", "users.json", "sessions.json"]
+SNAPSHOT_FILE = "elementary.snapshot"
+SNAPSHOT_VERSION = 7
+FINGERPRINT_SIZE = 1 << 20
+
+
+# Collection files are recognised by the end of their name, so both users.json and the timestamped
+# 20190112_users.json count as users.
+def collection_type(file_name):
+    base = os.path.basename(file_name).lower()
+    for file in COLLECTION_FILES:
+        if base == file or (base.endswith(file) and not base[-len(file) - 1].isalnum()):
+            return file[:-5]
+    return None
+
+
+# Collection files (type -> list of files) in the given folders, files and globs.  Files are kept in the order they
+# were given, and sorted by name within a folder, so that the newer of two timestamped collections comes last.
+def find_collection_files(paths):
+    files = dict((file[:-5], []) for file in COLLECTION_FILES)
+    for path in paths:
+        for match in sorted(glob.glob(path)):
+            if os.path.isdir(match):
+                candidates = [os.path.join(match, name) for name in sorted(os.listdir(match))]
+            else:
+                candidates = [match]
+            for candidate in candidates:
+                if candidate.lower().endswith(".zip") and os.path.isfile(candidate):
+                    with zipfile.ZipFile(candidate) as archive:
+                        members = sorted(name for name in archive.namelist() if not name.endswith("/"))
+                    sources = [ZIP_SEPARATOR.join([candidate, member]) for member in members]
+                elif os.path.isfile(candidate):
+                    sources = [candidate]
+                else:
+                    sources = []
+                for source in sources:
+                    type_label = collection_type(source)
+                    if type_label is not None and source not in files[type_label]:
+                        files[type_label].append(source)
+    return files
+
+
+def collection_file_list(files):
+    return [json_file for file in COLLECTION_FILES for json_file in files[file[:-5]]]
+
+
+# Objects that appear in several collections are merged into one (see Record.merge), later files winning.
+def merge_records(records):
+    merged = {}
+    for record in records:
+        older = merged.get(record.name_id)
+        merged[record.name_id] = record if older is None else record.merge(older)
+    return list(merged.values())
+
+
+# Runs in a worker process.  The file is parsed against a fresh name table and shipped back column-wise; the parent
+# remaps the ids into its own table when it merges the result.
+def parse_file(type_label, json_file):
+    start = time.time()
+    gc.disable()
+    bh_names.reset([])
+    if type_label == "sessions":
+        payload = read_session_pairs(json_file)
+    else:
+        record_class = dict(COLLECTION_CLASSES)[type_label].record_class
+        payload = record_class.pack(read_records(record_class, type_label, json_file))
+    return bh_names.names, payload, time.time() - start
+
+
+def parse_files(files, jobs):
+    json_files = collection_file_list(files)
+    print("Parsing {} files with {} processes...".format(len(json_files), jobs))
+    parsed = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        for json_file in json_files:
+            futures[executor.submit(parse_file, collection_type(json_file), json_file)] = json_file
+        for future in concurrent.futures.as_completed(futures):
+            json_file = futures[future]
+            names, payload, elapsed = future.result()
+            print("  Parsed {} in {:.2f}s.".format(json_file, elapsed))
+            type_stats = file_stats(collection_type(json_file))
+            type_stats["parse_seconds"] = type_stats.get("parse_seconds", 0) + elapsed
+            parsed[json_file] = (names, payload)
+    return parsed
+
+
+# Records or session pairs of one file, either parsed here or taken over from a worker process.
+def read_payload(type_label, json_file, parsed):
+    if json_file not in parsed:
+        if type_label == "sessions":
+            return read_session_pairs(json_file)
+        return read_records(dict(COLLECTION_CLASSES)[type_label].record_class, type_label, json_file)
+
+    names, payload = parsed.pop(json_file)
+    remap = array("i", (bh_names.intern(name) for name in names))
+    if type_label == "sessions":
+        users, computers, session_count = payload
+        return (array("i", (remap[user] for user in users)),
+                array("i", (remap[computer] for computer in computers)), session_count)
+    record_class = dict(COLLECTION_CLASSES)[type_label].record_class
+    return record_class.unpack(record_class.remap(payload, remap))
+
+
+def file_stats(type_label):
+    return bh_stats["load"]["files"].setdefault(type_label, {})
 
-        if target_name == source_name and target_type == "users":
-            return [deque([{"users": target_name}])]
+
+# Loads a single collection folder, or all the files (type -> list of files) found by find_collection_files.
+def load_collection(collection, jobs=1):
+    start = time.time()
+    if isinstance(collection, str):
+        files = find_collection_files([collection])
+    else:
+        files = collection
+    bh_stats["load"] = {"source": collection if isinstance(collection, str) else collection_file_list(files),
+                        "jobs": jobs, "files": {}}
+    # Loading only ever adds long-lived objects, so cyclic garbage collection passes are wasted work here.
+    gc.disable()
+    try:
+        _load_collection(files, jobs)
+    finally:
+        gc.enable()
+    finish_load_stats(time.time() - start)
+
+
+# Object counts, graph size and memory once everything is in, whether it came from the json files or a snapshot.
+def finish_load_stats(seconds):
+    load_stats = bh_stats["load"]
+    for type_label, objects in bh_data.items():
+        file_stats(type_label)["objects"] = len(objects.data_dict)
+    sessions = bh_sessions["sessions"].data_dict["computers"]
+    file_stats("sessions")["objects"] = sum(len(users) for users in sessions.values())
+    load_stats["nodes"] = bh_graph["graph"].node_count
+    load_stats["edges"] = bh_graph["graph"].edge_count
+    load_stats["seconds"] = seconds
+    load_stats["peak_memory_mb"] = peak_memory_mb()
+    if load_stats["peak_memory_mb"] is None:
+        print("Loaded everything in {:.2f}s.".format(seconds))
+    else:
+        print("Loaded everything in {:.2f}s, peak memory {:.0f} MB.".format(seconds, load_stats["peak_memory_mb"]))
+
+
+def _load_type(type_label, collection_class, json_files, parsed, lazy=False):
+    start = time.time()
+    if lazy and type_label != "sessions":
+        print("Loading {}...".format(type_label))
+        records = []
+        for json_file in json_files:
+            records.extend(read_records(collection_class.record_class, type_label, json_file, lazy))
+        loaded = collection_class(records=merge_records(records) if len(json_files) > 1 else records)
+    elif len(json_files) == 1 and json_files[0] not in parsed:
+        loaded = collection_class(json_files[0])
+    elif type_label == "sessions":
+        users = array("i")
+        computers = array("i")
+        session_count = 0
+        for json_file in json_files:
+            file_users, file_computers, file_count = read_payload(type_label, json_file, parsed)
+            users.extend(file_users)
+            computers.extend(file_computers)
+            session_count += file_count
+        loaded = Sessions(pairs=(users, computers, session_count))
+    else:
+        records = []
+        for json_file in json_files:
+            records.extend(read_payload(type_label, json_file, parsed))
+        loaded = collection_class(records=merge_records(records) if len(json_files) > 1 else records)
+    file_stats(type_label)["files"] = len(json_files)
+    file_stats(type_label)["seconds"] = time.time() - start
+    if lazy:
+        if type_label == "sessions":
+            file_stats(type_label)["objects"] = sum(len(users) for users in loaded.data_dict["computers"].values())
         else:
-            groups = set(bh_data["groups"].for_member(source_name))
-            trace_history.dedupe_groups(groups)
-
-            for group in groups:
-                trace_history.add_group(group)
-                group_paths = bh_data["groups"].trace(group, target_type, target_name, trace_history.copy())
-                for gp in group_paths:
-                    gp.appendleft({"users": source_name})
-                    paths.append(gp)
-
-            local_admin, remote_desktop = bh_data["computers"].list_access(source_name, groups)
-            # TODO: currently only looks at local admin.  Could consider remotedesktop and DcomUsers
-
-            computers = set(local_admin)
-            trace_history.dedupe_computers(computers)
-
-            for computer in computers:
-                trace_history.add_computer(computer)
-                computer_paths = bh_data["computers"].trace(computer, target_type, target_name, trace_history.copy())
-                for cp in computer_paths:
-                    cp.appendleft({"users": source_name, "localadmin": computer in local_admin})
-                    paths.append(cp)
-
-        return paths
+            file_stats(type_label)["objects"] = len(loaded.data_dict)
+    if len(json_files) == 1:
+        print("  Loaded {} in {:.2f}s.".format(os.path.basename(json_files[0]), time.time() - start))
+    else:
+        print("  Loaded {} {} files in {:.2f}s.".format(len(json_files), type_label, time.time() - start))
+    return loaded
+
+
+def _build_graph():
+    start = time.time()
+    graph = TraceGraph(bh_data, bh_sessions["sessions"])
+    bh_stats["load"]["graph_seconds"] = time.time() - start
+    bh_stats["load"]["nodes"] = graph.node_count
+    bh_stats["load"]["edges"] = graph.edge_count
+    print("  Built the trace graph in {:.2f}s.".format(time.time() - start))
+    return graph
+
+
+# Lazy mode: nothing is read up front.  Each type of file is loaded the first time a command looks it up (the trace
+# graph the first time a trace or reach needs it), and objects only keep where they are in their file, so describe
+# reads them back one at a time instead of keeping every object's details in memory.
+def defer_collection(files):
+    bh_stats["load"] = {"source": collection_file_list(files), "lazy": True, "files": {}}
+    bh_data.clear()
+    for type_label, collection_class in COLLECTION_CLASSES:
+        bh_data[type_label] = Deferred(functools.partial(_load_type, type_label, collection_class, files[type_label],
+                                                         {}, True))
+    bh_sessions.clear()
+    bh_sessions["sessions"] = Deferred(functools.partial(_load_type, "sessions", Sessions, files["sessions"], {}, True))
+    bh_graph.clear()
+    bh_graph["graph"] = Deferred(_build_graph)
+
+
+def _load_collection(files, jobs):
+    parsed = {}
+    if jobs > 1:
+        parsed = parse_files(files, jobs)
+
+    for type_label, collection_class in COLLECTION_CLASSES + [("sessions", Sessions)]:
+        loaded = _load_type(type_label, collection_class, files[type_label], parsed)
+        if type_label == "sessions":
+            bh_sessions["sessions"] = loaded
+        else:
+            bh_data[type_label] = loaded
+    bh_graph["graph"] = _build_graph()
+
+    start = time.time()
+    bh_data["computers"].effective_counts()
+    bh_stats["load"]["effective_access_seconds"] = time.time() - start
+    print("  Counted effective access in {:.2f}s.".format(time.time() - start))
+
+    start = time.time()
+    for objects in bh_data.values():
+        objects.name_index()
+    bh_stats["load"]["name_index_seconds"] = time.time() - start
+    print("Indexed all names in {:.2f}s.".format(time.time() - start))
+
+
+# Swaps in freshly collected sessions without reloading anything else.  Only the sessions that changed are applied to
+# the session indexes and the trace graph's HasSession edges; everything else derived from sessions is computed on
+# demand.  Returns the number of sessions added and removed.  Every file is read before anything is replaced, so a file
+# without a sessions array (MissingArray) leaves the loaded sessions as they were.
+def reload_sessions(json_files):
+    users = array("i")
+    computers = array("i")
+    for json_file in json_files:
+        file_users, file_computers, _ = read_session_pairs(json_file, required=True)
+        users.extend(file_users)
+        computers.extend(file_computers)
+    added, removed = bh_sessions["sessions"].replace(users, computers)
+    # In lazy mode a trace graph that hasn't been built yet will be built from the new sessions anyway.
+    graph = already_loaded(bh_graph).get("graph")
+    if graph is not None:
+        graph.update_sessions(added, removed)
+    if "load" in bh_stats:
+        sessions = bh_sessions["sessions"].data_dict["computers"]
+        file_stats("sessions")["objects"] = sum(len(users) for users in sessions.values())
+        if graph is not None:
+            bh_stats["load"]["edges"] = graph.edge_count
+    return len(added), len(removed)
+
+
+# Size, mtime and a hash of the head and tail of the file: cheap enough for multi-gigabyte files, but still catches a
+# collection that was replaced in place.
+def file_fingerprint(file_name):
+    archive_name, member = split_source(file_name)
+    if member is not None:
+        # The zip directory already has a CRC of every member, no need to decompress anything.
+        with zipfile.ZipFile(archive_name) as archive:
+            info = archive.getinfo(member)
+        return [member, info.file_size, os.stat(archive_name).st_mtime_ns, "{:08x}".format(info.CRC)]
+    stat = os.stat(file_name)
+    digest = hashlib.sha1()
+    with open(file_name, "rb") as f:
+        digest.update(f.read(FINGERPRINT_SIZE))
+        if stat.st_size > FINGERPRINT_SIZE:
+            f.seek(max(FINGERPRINT_SIZE, stat.st_size - FINGERPRINT_SIZE))
+            digest.update(f.read(FINGERPRINT_SIZE))
+    return [os.path.basename(file_name), stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+
+
+# A single folder keeps its snapshot in elementary.snapshot; a merged set of collections gets one named after the files
+# it was built from, next to the first of them.
+def snapshot_path(paths, source_files):
+    if len(paths) == 1 and os.path.isdir(paths[0]):
+        return os.path.join(paths[0], SNAPSHOT_FILE)
+    digest = hashlib.sha1("\n".join(os.path.abspath(f) for f in source_files).encode("utf-8")).hexdigest()
+    return os.path.join(os.path.dirname(split_source(source_files[0])[0]), "elementary-{}.snapshot".format(digest[:12]))
+
+
+def snapshot_header(source_files):
+    return {"version": SNAPSHOT_VERSION, "byteorder": sys.byteorder, "int_size": array("i").itemsize,
+            "node_types": list(NODE_TYPES), "sources": [file_fingerprint(f) for f in source_files]}
+
+
+# Snapshots hold data only, nothing that is executed or turned back into arbitrary objects: a JSON header line, a JSON
+# line describing the loaded data, then the raw bytes of every array it refers to.  In the description an array is
+# {"$array": n}, the n-th of those arrays, and a list of byte strings (record details) is {"$blobs": n, "$lengths": m}.
+def encode_snapshot(value, arrays):
+    if isinstance(value, array):
+        arrays.append(value)
+        return {"$array": len(arrays) - 1}
+    if isinstance(value, dict):
+        return dict((key, encode_snapshot(item, arrays)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        if len(value) > 0 and isinstance(value[0], bytes):
+            lengths = encode_snapshot(array("i", (len(blob) for blob in value)), arrays)["$array"]
+            return {"$blobs": encode_snapshot(array("B", b"".join(value)), arrays)["$array"], "$lengths": lengths}
+        if len(value) > 0 and isinstance(value[0], (dict, list, tuple, array)):
+            return [encode_snapshot(item, arrays) for item in value]
+        return list(value)
+    return value
+
+
+def decode_snapshot(value, arrays):
+    if isinstance(value, dict):
+        if "$array" in value:
+            return arrays[value["$array"]]
+        if "$blobs" in value:
+            blobs = arrays[value["$blobs"]].tobytes()
+            results = []
+            start = 0
+            for length in arrays[value["$lengths"]]:
+                results.append(blobs[start:start + length])
+                start += length
+            return results
+        return dict((key, decode_snapshot(item, arrays)) for key, item in value.items())
+    if isinstance(value, list) and len(value) > 0 and isinstance(value[0], (dict, list)):
+        return [decode_snapshot(item, arrays) for item in value]
+    return value
+
+
+def save_snapshot(snapshot_file, source_files):
+    print("Writing snapshot {}...".format(snapshot_file))
+    data = {"data": dict((type_label, objects.pack()) for type_label, objects in bh_data.items()),
+            "sessions": bh_sessions["sessions"].pack(),
+            "graph": bh_graph["graph"].pack()}
+    # Last, as packing may intern names.
+    data["names"] = bh_names.names
+    arrays = []
+    description = encode_snapshot(data, arrays)
+    temp_file = "{}.tmp".format(snapshot_file)
+    with open(temp_file, "wb") as f:
+        f.write(json.dumps(snapshot_header(source_files)).encode("utf-8") + b"\n")
+        f.write(json.dumps({"arrays": [[packed.typecode, len(packed)] for packed in arrays],
+                            "data": description}).encode("utf-8") + b"\n")
+        for packed in arrays:
+            packed.tofile(f)
+    os.replace(temp_file, snapshot_file)
+
+
+# Each array is read straight into its own memory, as the arrays stay in use long after the file is closed.
+def read_snapshot_arrays(f, layout):
+    arrays = []
+    remaining = os.fstat(f.fileno()).st_size - f.tell()
+    for typecode, length in layout:
+        size = length * array(typecode).itemsize
+        if length < 0 or size > remaining:
+            raise ValueError("the file is truncated")
+        packed = array(typecode, [0]) * length
+        if f.readinto(packed) != size:
+            raise ValueError("the file is truncated")
+        arrays.append(packed)
+        remaining -= size
+    return arrays
+
+
+def load_snapshot(snapshot_file, source_files):
+    if not os.path.exists(snapshot_file) or os.path.getsize(snapshot_file) == 0:
+        return False
+    print("Loading snapshot {}...".format(snapshot_file))
+    start = time.time()
+    with open(snapshot_file, "rb") as f:
+        try:
+            header = json.loads(f.readline().decode("utf-8"))
+        except ValueError:
+            print("  Snapshot is unreadable, rebuilding it.")
+            return False
+        if header != snapshot_header(source_files):
+            print("  Snapshot is out of date, rebuilding it.")
+            return False
+        # Indexing creates millions of containers and none of them are garbage, so keep the collector out of it.
+        gc.disable()
+        try:
+            layout = json.loads(f.readline().decode("utf-8"))
+            snapshot = decode_snapshot(layout["data"], read_snapshot_arrays(f, layout["arrays"]))
+            bh_names.reset(snapshot["names"])
+            collection_classes = dict(COLLECTION_CLASSES)
+            data = dict((type_label, collection_classes[type_label].unpack(state))
+                        for type_label, state in snapshot["data"].items())
+            sessions = Sessions.unpack(snapshot["sessions"])
+            graph = TraceGraph.unpack(snapshot["graph"])
+        except (ValueError, TypeError, KeyError, IndexError) as e:
+            bh_names.reset([])
+            print("  Snapshot is unreadable ({}), rebuilding it.".format(e))
+            return False
+        finally:
+            gc.enable()
+
+    bh_data.clear()
+    bh_data.update(data)
+    bh_sessions.clear()
+    bh_sessions["sessions"] = sessions
+    bh_graph.clear()
+    bh_graph["graph"] = graph
+    bh_stats["load"] = {"source": snapshot_file, "files": {}}
+    finish_load_stats(time.time() - start)
+    return True
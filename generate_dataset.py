@@ -0,0 +1,227 @@
+import argparse
+import json
+import os
+import random
+import sys
+
+
+# Synthetic collections in the same json layout bloodhound.py/SharpHound write, for testing and benchmarking Elementary
+# without a real domain.  The same options and seed always produce the same files.
+
+# Bumped whenever the same options start producing different files, so that collections kept from older runs (e.g.
+# by benchmark.py) aren't reused.
+GENERATOR_VERSION = 2
+
+# Share of the objects that are users, computers and groups.
+OBJECT_SHARES = (0.45, 0.40, 0.15)
+
+TRUST_TYPES = ["ParentChild", "External", "Forest"]
+
+
+class Domain:
+    def __init__(self, index, name):
+        self.index = index
+        self.name = name
+        self.users = []
+        self.computers = []
+        self.groups = []
+        self.levels = []
+        self.high_value = ["DOMAIN ADMINS@{}".format(name), "ADMINISTRATORS@{}".format(name)]
+        if index == 0:
+            self.high_value.append("ENTERPRISE ADMINS@{}".format(name))
+        self.domain_users = "DOMAIN USERS@{}".format(name)
+        self.domain_computers = "DOMAIN COMPUTERS@{}".format(name)
+
+
+class Generator:
+    def __init__(self, users, computers, groups, domains=1, depth=4, cycles=0, sessions=2.0, groups_per_user=3,
+                 admins_per_computer=2, seed=1):
+        self.random = random.Random(seed)
+        self.depth = max(1, depth)
+        self.cycles = cycles
+        self.session_density = sessions
+        self.groups_per_user = groups_per_user
+        self.admins_per_computer = admins_per_computer
+        self.domains = [Domain(i, "DOMAIN{}.LOCAL".format(i) if i > 0 else "EVIL.LOCAL") for i in range(domains)]
+        for i in range(users):
+            domain = self.domains[i % domains]
+            domain.users.append("USER{}@{}".format(i, domain.name))
+        for i in range(computers):
+            domain = self.domains[i % domains]
+            domain.computers.append("HOST{}.{}".format(i, domain.name))
+        for i in range(groups):
+            domain = self.domains[i % domains]
+            domain.groups.append("GROUP{}@{}".format(i, domain.name))
+        self.members = {}
+        self.parents = {}
+        self.levels = {}
+        self._nest_groups()
+
+    def all_users(self):
+        return [user for domain in self.domains for user in domain.users]
+
+    def all_computers(self):
+        return [computer for domain in self.domains for computer in domain.computers]
+
+    def _add_member(self, group, name, member_type):
+        self.members.setdefault(group, []).append({"MemberName": name, "MemberType": member_type})
+
+    # Groups are spread over `depth` levels; every group below the top level is nested in one or two groups of the
+    # level above, and the built in groups sit at the top.  Cycles are made by nesting a top level group back into
+    # one of its own descendants at the bottom, found by walking up from the bottom group through its parents.
+    def _nest_groups(self):
+        r = self.random
+        for domain in self.domains:
+            levels = [list(domain.high_value)] + [[] for _ in range(self.depth - 1)]
+            for i, group in enumerate(domain.groups):
+                levels[i * self.depth // max(1, len(domain.groups))].append(group)
+            for level, groups in enumerate(levels):
+                for group in groups:
+                    self.levels[group] = level
+                    if level > 0 and len(levels[level - 1]) > 0:
+                        for parent in r.sample(levels[level - 1], min(len(levels[level - 1]), r.randint(1, 2))):
+                            self._add_member(parent, group, "group")
+                            self.parents.setdefault(group, []).append(parent)
+            for group in [domain.domain_users, domain.domain_computers]:
+                self.levels[group] = self.depth - 1
+            domain.levels = levels
+
+        bottoms = [(domain, group) for domain in self.domains for group in domain.levels[-1]]
+        for _ in range(self.cycles if len(bottoms) > 0 and self.depth > 1 else 0):
+            group = ancestor = r.choice(bottoms)[1]
+            while ancestor in self.parents:
+                ancestor = r.choice(self.parents[ancestor])
+            if ancestor != group:
+                self._add_member(group, ancestor, "group")
+
+        for domain in self.domains:
+            candidates = domain.groups or domain.high_value
+            for user in domain.users:
+                self._add_member(domain.domain_users, user, "user")
+                for group in r.sample(candidates, min(len(candidates), r.randint(0, self.groups_per_user * 2))):
+                    self._add_member(group, user, "user")
+            for computer in domain.computers:
+                self._add_member(domain.domain_computers, computer, "computer")
+            # A couple of real admins, so there is always something at the end of a trace.
+            for user in domain.users[:2]:
+                self._add_member(domain.high_value[0], user, "user")
+
+    def computers(self):
+        r = self.random
+        for domain in self.domains:
+            deep_groups = [group for group in domain.groups if self.levels[group] > 0] or domain.high_value
+            for computer in domain.computers:
+                local_admins = [{"Name": domain.high_value[0], "Type": "Group"}]
+                for user in r.sample(domain.users, min(len(domain.users), r.randint(0, self.admins_per_computer))):
+                    local_admins.append({"Name": user, "Type": "User"})
+                if r.random() < 0.5:
+                    local_admins.append({"Name": r.choice(deep_groups), "Type": "Group"})
+                if r.random() < 0.05 and len(domain.computers) > 1:
+                    local_admins.append({"Name": r.choice(domain.computers), "Type": "Computer"})
+                remote_desktop = []
+                if r.random() < 0.3 and len(domain.users) > 0:
+                    remote_desktop.append({"Name": r.choice(domain.users), "Type": "User"})
+                if r.random() < 0.1:
+                    remote_desktop.append({"Name": r.choice(deep_groups), "Type": "Group"})
+                yield {
+                    "Name": computer,
+                    "PrimaryGroup": domain.domain_computers,
+                    "LocalAdmins": local_admins,
+                    "RemoteDesktopUsers": remote_desktop,
+                    "Properties": {"name": computer, "domain": domain.name, "enabled": True,
+                                   "operatingsystem": r.choice(["Windows 10 Enterprise", "Windows Server 2016"])},
+                }
+
+    def domain_objects(self):
+        for domain in self.domains:
+            trusts = []
+            for other in self.domains:
+                if other is not domain and (other.index == 0 or domain.index == 0):
+                    trusts.append({"TargetName": other.name, "IsTransitive": True, "TrustDirection": 3,
+                                   "TrustType": TRUST_TYPES[(domain.index + other.index) % len(TRUST_TYPES)]})
+            yield {"Name": domain.name, "Properties": {"name": domain.name, "functionallevel": "2016"},
+                   "Trusts": trusts}
+
+    def group_objects(self):
+        for domain in self.domains:
+            for group in domain.high_value + [domain.domain_users, domain.domain_computers] + domain.groups:
+                yield {"Name": group, "Members": self.members.get(group, []),
+                       "Properties": {"name": group, "domain": domain.name, "highvalue": group in domain.high_value}}
+
+    def user_objects(self):
+        for domain in self.domains:
+            for user in domain.users:
+                yield {"Name": user, "PrimaryGroup": domain.domain_users,
+                       "Properties": {"name": user, "domain": domain.name, "enabled": True,
+                                      "displayname": user.split("@")[0].title()}}
+
+    # Session counts are skewed like in a real domain: a few busy users and servers account for most sessions.
+    def session_objects(self):
+        r = self.random
+        users = self.all_users()
+        computers = self.all_computers()
+        if len(users) == 0 or len(computers) == 0:
+            return
+        for _ in range(int(len(users) * self.session_density)):
+            yield {"UserName": users[int(len(users) * r.random() ** 2)],
+                   "ComputerName": computers[int(len(computers) * r.random() ** 3)], "Weight": 1}
+
+
+def write_json(file_name, type_label, objects):
+    count = 0
+    with open(file_name, "w") as f:
+        f.write('{{"{}": ['.format(type_label))
+        for obj in objects:
+            if count > 0:
+                f.write(",\n")
+            f.write(json.dumps(obj))
+            count += 1
+        f.write('],\n"meta": {}}}\n'.format(json.dumps({"count": count, "type": type_label, "version": 3})))
+    return count
+
+
+def generate(path, generator):
+    os.makedirs(path, exist_ok=True)
+    for type_label, objects in [("computers", generator.computers()), ("domains", generator.domain_objects()),
+                                ("groups", generator.group_objects()), ("users", generator.user_objects()),
+                                ("sessions", generator.session_objects())]:
+        count = write_json(os.path.join(path, "{}.json".format(type_label)), type_label, objects)
+        print("  Wrote {} {}.".format(count, type_label))
+
+
+def split_objects(objects):
+    users, computers, groups = [max(1, int(objects * share)) for share in OBJECT_SHARES]
+    return users, computers, groups
+
+
+def add_arguments(parser):
+    parser.add_argument('--objects', type=int, default=10000,
+                        help="Total number of users, computers and groups (default: 10000).")
+    parser.add_argument('--domains', type=int, default=1, help="Number of domains, all trusting the first one.")
+    parser.add_argument('--depth', type=int, default=4, help="Levels of group nesting (default: 4).")
+    parser.add_argument('--cycles', type=int, default=0, help="Number of circular group memberships to add.")
+    parser.add_argument('--sessions', type=float, default=2.0, help="Average sessions per user (default: 2.0).")
+    parser.add_argument('--groups-per-user', type=int, default=3,
+                        help="Average number of groups each user is directly in (default: 3).")
+    parser.add_argument('--admins-per-computer', type=int, default=2,
+                        help="Maximum number of users with direct local admin on each computer (default: 2).")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed (default: 1).")
+
+
+def generator_from_args(args):
+    users, computers, groups = split_objects(args.objects)
+    return Generator(users, computers, groups, domains=max(1, args.domains), depth=args.depth, cycles=args.cycles,
+                     sessions=args.sessions, groups_per_user=args.groups_per_user,
+                     admins_per_computer=args.admins_per_computer, seed=args.seed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic Bloodhound collection for testing Elementary.')
+    parser.add_argument('path', help="The folder to write computers/domains/groups/users/sessions.json to.")
+    add_arguments(parser)
+    args = parser.parse_args()
+    if args.objects < 1:
+        print("--objects must be at least 1.")
+        sys.exit(1)
+    print("Generating {} objects into {}...".format(args.objects, args.path))
+    generate(args.path, generator_from_args(args))
@@ -0,0 +1,104 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import elementary_data  # noqa: E402
+
+
+# Numbers, escapes and multi-byte characters land on every possible read boundary somewhere in here, at the top
+# level, inside the array and inside nested values.
+FIXTURE = """\
+{
+  "meta" : 638201.5, "skipped": [1.25e-3, [-0.5E+2, "a\\"]b"], {"x": [0, 1e5]}],
+  "unicode": "\\u00e9\\ud83d\\ude00 é漢\U0001F600",
+  "data" : [
+    {"Name": "ALICE@CORP.LOCAL", "score": 638201.75, "tags": ["a\\\\b", "\\"q\\"", "\\n\\t\\/"]},
+    638201.5 ,1e-5,-0.25E+3, 12345678901234567890, 0.0, -0, true, false, null,
+    [[1.5, [2.25, []]], {}, "]", ",", "\\u005d"],
+    {"nested": {"list": [3.14159, -2.5e10, {"deep": ["üß", 7.0]}]}, "empty": ""},
+    "trailing 漢字",
+    1234.5
+  ],
+  "after": 9.75
+}"""
+
+
+class JsonStreamBoundaryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.read_size = elementary_data.READ_SIZE
+        handle, self.path = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(handle, "wb") as f:
+            f.write(FIXTURE.encode("utf-8"))
+        self.expected = json.loads(FIXTURE)
+
+    def tearDown(self):
+        elementary_data.READ_SIZE = self.read_size
+        os.remove(self.path)
+
+    def read_sizes(self):
+        for read_size in range(1, 9):
+            elementary_data.READ_SIZE = read_size
+            with self.subTest(read_size=read_size):
+                yield read_size
+
+    def test_array(self):
+        for _ in self.read_sizes():
+            self.assertEqual(list(elementary_data.iter_json_array(self.path, "data")), self.expected["data"])
+
+    def test_spans(self):
+        raw = FIXTURE.encode("utf-8")
+        for _ in self.read_sizes():
+            values = list(elementary_data.iter_json_array(self.path, "data", spans=True))
+            self.assertEqual([value for value, _, _ in values], self.expected["data"])
+            for value, start, end in values:
+                self.assertEqual(json.loads(raw[start:end].decode("utf-8")), value)
+
+    def test_top_level_values(self):
+        for _ in self.read_sizes():
+            with open(self.path, "rb") as f:
+                stream = elementary_data.JsonStream(f, "fixture")
+                stream.expect("{")
+                decoded = {}
+                while stream.peek_char() != "}":
+                    name = stream.decode()
+                    stream.expect(":")
+                    decoded[name] = stream.decode()
+                    if stream.next_char() != ",":
+                        break
+                self.assertEqual(decoded, self.expected)
+                self.assertEqual(type(decoded["meta"]), float)
+
+    def test_byte_order_mark(self):
+        raw = b"\xef\xbb\xbf" + FIXTURE.encode("utf-8")
+        with open(self.path, "wb") as f:
+            f.write(raw)
+        for _ in self.read_sizes():
+            for value, start, end in elementary_data.iter_json_array(self.path, "data", spans=True):
+                self.assertEqual(json.loads(raw[start:end].decode("utf-8")), value)
+
+    def test_zip_member(self):
+        archive = self.path + ".zip"
+        with zipfile.ZipFile(archive, "w") as f:
+            f.write(self.path, "users.json")
+        try:
+            for _ in self.read_sizes():
+                source = archive + elementary_data.ZIP_SEPARATOR + "users.json"
+                self.assertEqual(list(elementary_data.iter_json_array(source, "data")), self.expected["data"])
+        finally:
+            os.remove(archive)
+
+    def test_missing_array(self):
+        for _ in self.read_sizes():
+            self.assertEqual(list(elementary_data.iter_json_array(self.path, "users")), [])
+            with self.assertRaises(elementary_data.MissingArray):
+                list(elementary_data.iter_json_array(self.path, "meta", required=True))
+
+
+if __name__ == "__main__":
+    unittest.main()